@@ -5,7 +5,7 @@ from django.conf import settings
 from pytz import datetime
 
 from ..accounts.models import ForwardEmail, User
-from ..utils.cipher import Cipher
+from ..utils.cipher import get_cipher
 from ..utils.email import SendEmail
 from ..utils.enum import MailAuthStatus
 
@@ -20,7 +20,7 @@ class EmailAuthenticate:
     def __init__(self, user, email):
         self.user = user
         self.email = email
-        self.cipher = Cipher(settings.EMAIL_AUTH_CRYPTO_KEY)
+        self.cipher = get_cipher(settings.EMAIL_AUTH_CRYPTO_KEY)
 
     def _generate_token(self):
         info = {
@@ -0,0 +1,259 @@
+from exchangelib.folders import Folder, FolderId
+from exchangelib.properties import ItemId
+from exchangelib.services import EWSAccountService
+from exchangelib.util import MNS, TNS, add_xml_child, create_element, set_xml_value
+
+
+class SyncService(EWSAccountService):
+    """同期状態 (SyncState) からの差分で変更を取得するサービスの基底クラス"""
+    element_container_name = '{%s}Changes' % MNS
+    # 最後の変更まで取得したかを示す要素
+    includes_last_tag = None
+
+    CREATE = 'Create'
+    UPDATE = 'Update'
+    DELETE = 'Delete'
+
+    def _get_changes(self, sync_state, **kwargs):
+        """変更を取得
+
+        最後の変更まで繰り返し取得し、取得後の同期状態を self.sync_state に設定する
+
+        Args:
+            sync_state(str): 前回の同期状態 (未指定の場合は全てを作成として取得)
+            kwargs: get_payload の引数
+        Returns:
+            generator(tuple(str, object)): 変更種別と、_parse_change で変換した変更内容
+        """
+        self.sync_state = sync_state
+        while True:
+            payload = self.get_payload(sync_state=self.sync_state, **kwargs)
+            message = self._get_response_xml(payload=payload)[0]
+            container = self._get_element_container(message=message, name=self.element_container_name)
+            if isinstance(container, Exception):
+                raise container
+
+            for change in container:
+                yield change.tag.replace('{%s}' % TNS, ''), self._parse_change(change)
+
+            # 変更を全て受け取ってから同期状態を進める
+            self.sync_state = message.find('{%s}SyncState' % MNS).text
+            if message.find(self.includes_last_tag).text == 'true':
+                break
+
+    def _parse_change(self, change):
+        raise NotImplementedError()
+
+
+class SyncFolderItems(SyncService):
+    """フォルダ内アイテムの変更を同期状態からの差分で取得
+
+    exchangelibに実装がないため、EWSのSyncFolderItemsを直接呼び出す
+    https://docs.microsoft.com/ja-jp/exchange/client-developer/web-service-reference/syncfolderitems-operation
+    """
+    SERVICE_NAME = 'SyncFolderItems'
+    includes_last_tag = '{%s}IncludesLastItemInRange' % MNS
+    # 1リクエストで取得する変更の最大件数 (EWSの上限は512)
+    MAX_CHANGES_RETURNED = 512
+
+    READ_FLAG_CHANGE = 'ReadFlagChange'
+
+    def call(self, folder, sync_state, additional_fields):
+        """変更を取得
+
+        Args:
+            folder(Folder): 対象フォルダ
+            sync_state(str): 前回の同期状態 (未指定の場合はフォルダ内の全アイテムを作成として取得)
+            additional_fields(set(FieldPath)): 作成・更新されたアイテムについて取得する項目
+        Returns:
+            generator(tuple(str, Item or str)): 変更種別と、アイテム (Create / Update) またはメール識別ID
+        """
+        return self._get_changes(sync_state, folder=folder, additional_fields=additional_fields)
+
+    def _parse_change(self, change):
+        elem = change[0]
+        if elem.tag == ItemId.response_tag():
+            return elem.get(ItemId.ID_ATTR)
+
+        return Folder.item_model_from_tag(elem.tag).from_xml(elem=elem, account=self.account)
+
+    def get_payload(self, folder, sync_state, additional_fields):
+        syncfolderitems = create_element('m:%s' % self.SERVICE_NAME)
+
+        itemshape = create_element('m:ItemShape')
+        add_xml_child(itemshape, 't:BaseShape', 'IdOnly')
+        if additional_fields:
+            expanded_fields = [field for f in additional_fields for field in f.expand(version=self.account.version)]
+            itemshape.append(set_xml_value(
+                create_element('t:AdditionalProperties'),
+                sorted(expanded_fields, key=lambda f: f.path),
+                version=self.account.version
+            ))
+        syncfolderitems.append(itemshape)
+
+        syncfolderid = create_element('m:SyncFolderId')
+        syncfolderid.append(folder.to_xml(version=self.account.version))
+        syncfolderitems.append(syncfolderid)
+
+        if sync_state:
+            add_xml_child(syncfolderitems, 'm:SyncState', sync_state)
+        add_xml_child(syncfolderitems, 'm:MaxChangesReturned', self.MAX_CHANGES_RETURNED)
+        return syncfolderitems
+
+
+class SyncFolderHierarchy(SyncService):
+    """フォルダ配下のフォルダ階層の変更を同期状態からの差分で取得
+
+    exchangelibに実装がないため、EWSのSyncFolderHierarchyを直接呼び出す
+    https://docs.microsoft.com/ja-jp/exchange/client-developer/web-service-reference/syncfolderhierarchy-operation
+    """
+    SERVICE_NAME = 'SyncFolderHierarchy'
+    includes_last_tag = '{%s}IncludesLastFolderInRange' % MNS
+
+    def call(self, folder, sync_state):
+        """変更を取得
+
+        Args:
+            folder(Folder): 対象フォルダ (変更は配下の全フォルダが対象で、フォルダ自身は含まない)
+            sync_state(str): 前回の同期状態 (未指定の場合は配下の全フォルダを作成として取得)
+        Returns:
+            generator(tuple(str, tuple(str, str))): 変更種別と、フォルダIDと変更キー
+        """
+        return self._get_changes(sync_state, folder=folder)
+
+    def _parse_change(self, change):
+        folder_id = next(change.iter(FolderId.response_tag()))
+        return folder_id.get(FolderId.ID_ATTR), folder_id.get(FolderId.CHANGEKEY_ATTR)
+
+    def get_payload(self, folder, sync_state):
+        syncfolderhierarchy = create_element('m:%s' % self.SERVICE_NAME)
+
+        foldershape = create_element('m:FolderShape')
+        add_xml_child(foldershape, 't:BaseShape', 'IdOnly')
+        syncfolderhierarchy.append(foldershape)
+
+        syncfolderid = create_element('m:SyncFolderId')
+        syncfolderid.append(folder.to_xml(version=self.account.version))
+        syncfolderhierarchy.append(syncfolderid)
+
+        if sync_state:
+            add_xml_child(syncfolderhierarchy, 'm:SyncState', sync_state)
+        return syncfolderhierarchy
+
+
+class Subscribe(EWSAccountService):
+    """フォルダのイベントをプル通知で購読
+
+    https://docs.microsoft.com/ja-jp/exchange/client-developer/web-service-reference/subscribe-operation
+    """
+    SERVICE_NAME = 'Subscribe'
+
+    def call(self, folders, event_types, timeout):
+        """購読を開始
+
+        Args:
+            folders(list(Folder)): 対象フォルダ
+            event_types(list(str)): 購読するイベント種別 (NewMailEvent など)
+            timeout(int): GetEventsが呼ばれない場合にサブスクリプションが失効するまでの時間 (分)
+        Returns:
+            tuple(str, str): サブスクリプションIDとウォーターマーク
+        """
+        message = self._get_response_xml(payload=self.get_payload(folders, event_types, timeout))[0]
+        result = self._get_element_container(message=message)
+        if isinstance(result, Exception):
+            raise result
+
+        return message.find('{%s}SubscriptionId' % MNS).text, message.find('{%s}Watermark' % MNS).text
+
+    def get_payload(self, folders, event_types, timeout):
+        subscribe = create_element('m:%s' % self.SERVICE_NAME)
+        request = create_element('m:PullSubscriptionRequest')
+
+        folder_ids = create_element('t:FolderIds')
+        for folder in folders:
+            folder_ids.append(folder.to_xml(version=self.account.version))
+        request.append(folder_ids)
+
+        event_types_elem = create_element('t:EventTypes')
+        for event_type in event_types:
+            add_xml_child(event_types_elem, 't:EventType', event_type)
+        request.append(event_types_elem)
+
+        add_xml_child(request, 't:Timeout', timeout)
+        subscribe.append(request)
+        return subscribe
+
+
+class GetEvents(EWSAccountService):
+    """プル通知で購読したイベントを取得
+
+    https://docs.microsoft.com/ja-jp/exchange/client-developer/web-service-reference/getevents-operation
+    """
+    SERVICE_NAME = 'GetEvents'
+    element_container_name = '{%s}Notification' % MNS
+    # イベント以外の要素
+    NON_EVENT_TAGS = ('SubscriptionId', 'PreviousWatermark', 'MoreEvents')
+
+    def call(self, subscription_id, watermark):
+        """前回のウォーターマーク以降のイベントを取得
+
+        Args:
+            subscription_id(str): サブスクリプションID
+            watermark(str): 前回のウォーターマーク
+        Returns:
+            tuple(list(tuple(str, str, str)), str, bool):
+                イベントリスト (種別, アイテムID, フォルダID) と次のウォーターマーク、未取得のイベントがあるか
+                アイテムのイベントはフォルダIDが、フォルダのイベントはアイテムIDが None になる
+        """
+        message = self._get_response_xml(payload=self.get_payload(subscription_id, watermark))[0]
+        notification = self._get_element_container(message=message, name=self.element_container_name)
+        if isinstance(notification, Exception):
+            raise notification
+
+        events = []
+        for elem in notification:
+            event_type = elem.tag.replace('{%s}' % TNS, '')
+            if event_type in self.NON_EVENT_TAGS:
+                continue
+
+            watermark = elem.find('{%s}Watermark' % TNS).text
+            item_id = elem.find(ItemId.response_tag())
+            folder_id = elem.find(FolderId.response_tag())
+            events.append((
+                event_type,
+                item_id.get(ItemId.ID_ATTR) if item_id is not None else None,
+                folder_id.get(FolderId.ID_ATTR) if folder_id is not None else None,
+            ))
+
+        more_events = notification.find('{%s}MoreEvents' % TNS).text == 'true'
+        return events, watermark, more_events
+
+    def get_payload(self, subscription_id, watermark):
+        getevents = create_element('m:%s' % self.SERVICE_NAME)
+        add_xml_child(getevents, 'm:SubscriptionId', subscription_id)
+        add_xml_child(getevents, 'm:Watermark', watermark)
+        return getevents
+
+
+class Unsubscribe(EWSAccountService):
+    """プル通知の購読を終了
+
+    https://docs.microsoft.com/ja-jp/exchange/client-developer/web-service-reference/unsubscribe-operation
+    """
+    SERVICE_NAME = 'Unsubscribe'
+
+    def call(self, subscription_id):
+        """購読を終了
+
+        Args:
+            subscription_id(str): サブスクリプションID
+        """
+        message = self._get_response_xml(payload=self.get_payload(subscription_id))[0]
+        result = self._get_element_container(message=message)
+        if isinstance(result, Exception):
+            raise result
+
+    def get_payload(self, subscription_id):
+        unsubscribe = create_element('m:%s' % self.SERVICE_NAME)
+        add_xml_child(unsubscribe, 'm:SubscriptionId', subscription_id)
+        return unsubscribe
@@ -6,7 +6,7 @@ from django.db import transaction
 from .models import ForwardEmail, User
 from .owa_account import OwaAccount
 from ..applications.models import ForwardType
-from ..utils.cipher import Cipher
+from ..utils.cipher import get_cipher
 
 
 class LoginForm(forms.Form):
@@ -30,7 +30,7 @@ class LoginForm(forms.Form):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.cipher = Cipher(settings.PERSONAL_CRYPTO_KEY)
+        self.cipher = get_cipher(settings.PERSONAL_CRYPTO_KEY)
 
     def clean(self):
         server = self.cleaned_data['server']
@@ -3,7 +3,7 @@ from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, Permis
 from django.db import models
 
 from ..mixins import CreateAndUpdateDateTimeMixin
-from ..utils.cipher import Cipher
+from ..utils.cipher import get_cipher
 from ..utils.enum import MailAuthStatus
 
 
@@ -48,11 +48,11 @@ class User(AbstractBaseUser, CreateAndUpdateDateTimeMixin, PermissionsMixin):
 
     @property
     def plane_username(self):
-        return Cipher(settings.PERSONAL_CRYPTO_KEY).decrypt(self.username)
+        return get_cipher(settings.PERSONAL_CRYPTO_KEY).decrypt(self.username)
 
     @property
     def plane_password(self):
-        return Cipher(settings.PERSONAL_CRYPTO_KEY).decrypt(self.password)
+        return get_cipher(settings.PERSONAL_CRYPTO_KEY).decrypt(self.password)
 
     class Meta:
         ordering = ['id']
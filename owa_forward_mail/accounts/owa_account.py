@@ -1,5 +1,6 @@
 import pytz
 
+from django.conf import settings
 from django.template import loader
 from exchangelib import (
     Account,
@@ -10,14 +11,33 @@ from exchangelib import (
     Message,
     ServiceAccount
 )
+from exchangelib.folders import Folder, FolderCollection, Root
 from exchangelib.items import BaseMeetingItem
-from exchangelib.errors import ErrorItemNotFound, ErrorNonExistentMailbox
+from exchangelib.errors import ErrorInvalidSyncStateData, ErrorItemNotFound, ErrorNonExistentMailbox
+
+from ..utils.timing import PhaseTimer, timed
+from .ews_services import GetEvents, Subscribe, SyncFolderHierarchy, SyncFolderItems, Unsubscribe
 
 
 class OwaAccount():
     WEEKS = ["月", "火", "水", "木", "金", "土", "日"]
-
-    def __init__(self, email, server, username, password, forward_email=None, enableFaultTolerance=False):
+    # 通知メールに表示する受信日時のタイムゾーン
+    TIMEZONE = pytz.timezone('Asia/Tokyo')
+    # 一括処理で1リクエストにまとめるメール件数
+    BULK_CHUNK_SIZE = 100
+    # 差出人と件名の通知で取得する項目 (IDは常に取得される)
+    SUMMARY_FIELDS = ['author', 'subject', 'datetime_received']
+    # 転送時に取得する項目 (会議招待の通知に使う項目を含む)
+    FORWARD_FIELDS = ['subject', 'author', 'datetime_received']
+    # 同期 (SyncFolderItems) で取得する項目
+    SYNC_FIELDS = ['is_read', 'datetime_received']
+    # 差出人と件名の通知で同期 (SyncFolderItems) から取得する項目
+    SYNC_SUMMARY_FIELDS = SYNC_FIELDS + ['author', 'subject']
+    # 新着メール通知で購読するイベント (フォルダの作成も CreatedEvent で通知される)
+    SUBSCRIBE_EVENT_TYPES = ['NewMailEvent', 'CreatedEvent']
+
+    def __init__(self, email, server, username, password, forward_email=None, enableFaultTolerance=False,
+                 sync_states=None, folder_hierarchy=None, timer=None):
         if enableFaultTolerance:
             credentials = ServiceAccount(
                 username=username,
@@ -29,17 +49,183 @@ class OwaAccount():
                 password=password
             )
 
-        self.account = Account(
-            primary_smtp_address=email,
-            config=Configuration(
+        if server in settings.EWS_SERVICE_ENDPOINTS:
+            # 設定で許可したURL (疑似サーバー) のみ、EWSのURLとして直接接続する
+            config = Configuration(
+                service_endpoint=server,
+                credentials=credentials,
+            )
+        else:
+            config = Configuration(
                 server=server,
                 credentials=credentials,
-            ),
+            )
+
+        self.account = Account(
+            primary_smtp_address=email,
+            config=config,
             autodiscover=False,
             access_type=DELEGATE,
         )
         self.forward_email = forward_email
+        self.read_flag_failures = []
+        # 処理段階ごとの所要時間 (ログインを含めて計測する場合は呼び出し側で作成して渡す)
+        self.timer = timer or PhaseTimer()
+        # フォルダIDごとの同期状態 指定した場合は検索ではなく前回からの変更で新着メールを取得
+        self.sync_states = sync_states
+        # 今回の同期後の同期状態 (処理に成功した場合のみ呼び出し側で保存する)
+        self.new_sync_states = None
+        # キャッシュしたフォルダ階層 指定した場合はサブフォルダを探索せず、前回からの変更のみ反映して使う
+        self.folder_hierarchy = folder_hierarchy
+        # 今回の更新後のフォルダ階層
+        self.new_folder_hierarchy = None
+
+    def commit_sync_states(self):
+        """保存した同期状態とフォルダ階層を、ログインしたまま次に処理する際の前回の状態にする
+
+        listen のように同じアカウントで繰り返し処理する場合のため、呼び出し側で保存した後に呼ぶ
+        """
+        if self.new_sync_states is not None:
+            self.sync_states = self.new_sync_states
+            self.new_sync_states = None
+        if self.new_folder_hierarchy is not None:
+            self.folder_hierarchy = self.new_folder_hierarchy
+            self.new_folder_hierarchy = None
+
+    def _sync_folder_hierarchy(self, folder_hierarchy):
+        """フォルダ階層に前回からの変更を反映
+
+        Args:
+            folder_hierarchy(dict): フォルダ階層
+                sync_state(str): 同期状態, inbox_id(str): 受信トレイのフォルダID, folders(dict): サブフォルダのフォルダIDと変更キー
+        Returns:
+            dict: 変更を反映したフォルダ階層
+        """
+        folders = dict(folder_hierarchy['folders'])
+
+        service = SyncFolderHierarchy(account=self.account)
+        inbox = Folder(root=Root(account=self.account), id=folder_hierarchy['inbox_id'])
+        for change_type, (folder_id, changekey) in service.call(inbox, folder_hierarchy['sync_state']):
+            if change_type == SyncFolderHierarchy.DELETE:
+                folders.pop(folder_id, None)
+            else:
+                folders[folder_id] = changekey
+
+        return {
+            'sync_state': service.sync_state,
+            'inbox_id': folder_hierarchy['inbox_id'],
+            'folders': folders,
+        }
+
+    def _refresh_folder_hierarchy(self):
+        """キャッシュしたフォルダ階層を更新
+
+        キャッシュがない場合や同期状態が無効になった場合は、受信トレイのIDを取得して全て取得し直す
+
+        Returns:
+            dict: 更新後のフォルダ階層 (_sync_folder_hierarchy 参照)
+        """
+        if self.folder_hierarchy:
+            try:
+                return self._sync_folder_hierarchy(self.folder_hierarchy)
+            except ErrorInvalidSyncStateData:
+                pass
+
+        return self._sync_folder_hierarchy({
+            'sync_state': None,
+            'inbox_id': self.account.inbox.id,
+            'folders': {},
+        })
+
+    @timed('folders')
+    def _get_target_folders(self):
+        """受信トレイおよびサブフォルダを取得
+
+        フォルダ階層をキャッシュしている場合は、1回の実行で1度だけ変更を反映し、フォルダの探索は行わない
 
+        Returns:
+            list(Folder): 受信トレイおよびサブフォルダ (先頭が受信トレイ)
+        """
+        if self.folder_hierarchy is None:
+            inbox = self.account.inbox
+            return [inbox] + list(inbox.walk())
+
+        if self.new_folder_hierarchy is None:
+            self.new_folder_hierarchy = self._refresh_folder_hierarchy()
+
+        # 変更キーは検索に使わないため、フォルダIDのみを指定する
+        root = Root(account=self.account)
+        folder_ids = [self.new_folder_hierarchy['inbox_id']] + list(self.new_folder_hierarchy['folders'])
+        return [Folder(root=root, id=folder_id) for folder_id in folder_ids]
+
+    def _filter_unread_mails(self, last_time):
+        """受信トレイおよびサブフォルダの未読メールを検索するクエリを作成
+
+        全てのフォルダを1つのFindItemで検索する
+        結果はフォルダごとにまとめて返されるため、受信日時順に並べる場合は取得後に並べ替えること
+
+        Args:
+            last_time(DateTime): 前回実行日時 (UTC)
+                未指定の場合は、全ての未読メールを取得
+        Returns:
+            QuerySet: 未読メールのクエリ
+        """
+        folders = FolderCollection(account=self.account, folders=self._get_target_folders())
+
+        unread_mails = folders.filter(is_read=False)
+        if last_time:
+            unread_mails = unread_mails.filter(datetime_received__gt=EWSDateTime.from_datetime(last_time))
+
+        return unread_mails
+
+    def _sync_folder(self, folder, sync_state, additional_fields):
+        """フォルダの変更を取得
+
+        Returns:
+            tuple(list(tuple(str, Item or str)), str): 変更リストと同期後の同期状態
+        """
+        service = SyncFolderItems(account=self.account)
+        changes = list(service.call(folder, sync_state, additional_fields))
+        return changes, service.sync_state
+
+    def _sync_unread_mails(self, last_time, fields=None):
+        """前回の同期状態からの変更で、新着の未読メールを取得
+
+        同期状態のないフォルダ (初回や新しいサブフォルダ) は全アイテムが作成として返るため、前回実行日時より後に受信したメールに絞る
+        同期後の同期状態は new_sync_states に設定する
+
+        Args:
+            last_time(DateTime): 前回実行日時 (UTC)
+                同期状態のないフォルダで未指定の場合は、全ての未読メールを取得
+            fields(list(str)): 取得する項目 (未指定の場合は SYNC_FIELDS)
+        Returns:
+            list(Item): 受信トレイおよびサブフォルダの新着の未読メール (受信日時順)
+        """
+        folders = self._get_target_folders()
+        additional_fields = folders[0].normalize_fields(fields=fields or self.SYNC_FIELDS)
+
+        mails = {}
+        new_sync_states = {}
+        for folder in folders:
+            sync_state = self.sync_states.get(folder.id)
+            try:
+                changes, new_sync_states[folder.id] = self._sync_folder(folder, sync_state, additional_fields)
+            except ErrorInvalidSyncStateData:
+                # 同期状態が無効になった場合は、同期状態のないフォルダとして取得し直す
+                sync_state = None
+                changes, new_sync_states[folder.id] = self._sync_folder(folder, sync_state, additional_fields)
+
+            for change_type, mail in changes:
+                if change_type != SyncFolderItems.CREATE or mail.is_read:
+                    continue
+                if not sync_state and last_time and mail.datetime_received <= last_time:
+                    continue
+                mails[mail.id] = mail
+
+        self.new_sync_states = new_sync_states
+        return sorted(mails.values(), key=lambda mail: mail.datetime_received)
+
+    @timed('find')
     def _get_unread_mail_ids(self, last_time):
         """未読メールIDを取得
 
@@ -47,16 +233,27 @@ class OwaAccount():
             last_time(DateTime): 前回実行日時 (UTC)
                 未指定の場合は、全ての未読メールを取得
         Returns:
-            list(str): 受信トレイおよびサブフォルダの未読メール識別ID (Message.id)
+            list(str): 受信トレイおよびサブフォルダの未読メール識別ID (Message.id) 受信日時順
         """
-        unread_inbox = self.account.inbox.filter(is_read=False)
-        unread_subfolder = self.account.inbox.walk().filter(is_read=False)
-        if last_time:
-            ews_last_time = EWSDateTime.from_datetime(last_time)
-            unread_inbox = unread_inbox.filter(datetime_received__gt=ews_last_time)
-            unread_subfolder = unread_subfolder.filter(datetime_received__gt=ews_last_time)
+        if self.sync_states is not None:
+            return [mail.id for mail in self._sync_unread_mails(last_time)]
 
-        return [mail.id for mail in unread_inbox] + [mail.id for mail in unread_subfolder]
+        # IDと並べ替えに使う受信日時のみを取得する
+        unread_mails = self._filter_unread_mails(last_time).values_list('id', 'datetime_received')
+        received_at_by_id = {mail_id: received_at for mail_id, received_at in unread_mails}
+
+        return sorted(received_at_by_id, key=received_at_by_id.get)
+
+    def _format_received_at(self, received_at):
+        """受信日時を通知メールの表示形式 (2019/01/01(火) 09:00:00) に変換
+
+        Args:
+            received_at(EWSDateTime): 受信日時
+        Returns:
+            str: 日本時間の受信日時
+        """
+        t = received_at.astimezone(self.TIMEZONE)
+        return f'{t.year}/{t.month:02}/{t.day:02}({self.WEEKS[t.weekday()]}) {t.hour:02}:{t.minute:02}:{t.second:02}'
 
     def _get_mail_infos(self, mails):
         """メール情報を取得
@@ -75,19 +272,16 @@ class OwaAccount():
             else:
                 author = f'{mail.author.name} <{mail.author.email_address}>'
 
-            received_at = mail.datetime_received.astimezone(pytz.timezone('Asia/Tokyo'))
-            received_at_str = received_at.strftime('%Y/%m/%d %H:%M:%S')
-            received_at_str = received_at_str.replace(' ', f'({self.WEEKS[received_at.weekday()]}) ')
-
             mail_infos.append({
                 'id': mail.id,
-                'received_at': received_at_str,
+                'received_at': self._format_received_at(mail.datetime_received),
                 'from': author,
                 'subject': mail.subject
             })
 
         return mail_infos
 
+    @timed('find')
     def _get_unread_mail_infos(self, last_time):
         """未読メール情報を取得
 
@@ -95,25 +289,52 @@ class OwaAccount():
             last_time(DateTime): 前回実行日時 (UTC)
                 未指定の場合は、全ての未読メールを取得
         Returns:
-            list(dict): 受信トレイおよびサブフォルダの未読メール情報
+            list(dict): 受信トレイおよびサブフォルダの未読メール情報 (受信日時順)
         """
-        inbox_mails = self.account.inbox.filter(is_read=False)
-        subfolder_mails = self.account.inbox.walk().filter(is_read=False)
-        if last_time:
-            ews_last_time = EWSDateTime.from_datetime(last_time)
-            inbox_mails = inbox_mails.filter(datetime_received__gt=ews_last_time)
-            subfolder_mails = subfolder_mails.filter(datetime_received__gt=ews_last_time)
+        if self.sync_states is not None:
+            # 通知に使う項目も同期で取得し、GetItemで取得し直さない
+            return self._get_mail_infos(self._sync_unread_mails(last_time, self.SYNC_SUMMARY_FIELDS))
 
-        return self._get_mail_infos(inbox_mails) + self._get_mail_infos(subfolder_mails)
+        # 通知に使う項目のみを取得し、本文などは取得しない
+        unread_mails = self._filter_unread_mails(last_time).only(*self.SUMMARY_FIELDS)
+        mails = {mail.id: mail for mail in unread_mails}
 
-    def _forward_mail(self, mail_id):
-        """メールを転送
+        return self._get_mail_infos(sorted(mails.values(), key=lambda mail: mail.datetime_received))
+
+    @timed('fetch')
+    def _fetch_mails(self, mail_ids):
+        """転送するメールを一括取得
+
+        転送に必要な項目のみを、BULK_CHUNK_SIZE 件ずつまとめたGetItemで取得する
+        フォルダを問わずIDで取得するため、サブフォルダのメールも対象になる
 
         Args:
-            mail_id(str): メール識別ID (Message.id)
+            mail_ids(list(str)): メール識別IDリスト (Message.id)
+        Returns:
+            list(Item): メールリスト (取得までの間に削除されたメールは除く)
         """
+        mails = []
+        results = self.account.fetch(
+            ids=[(mail_id, None) for mail_id in mail_ids],
+            only_fields=self.FORWARD_FIELDS,
+            chunk_size=self.BULK_CHUNK_SIZE
+        )
+        for result in results:
+            if isinstance(result, ErrorItemNotFound):
+                continue
+            elif isinstance(result, Exception):
+                raise result
+            mails.append(result)
+
+        return mails
 
-        mail = self.account.inbox.get(id=mail_id)
+    @timed('forward')
+    def _forward_mail(self, mail):
+        """メールを転送
+
+        Args:
+            mail(Item): _fetch_mails で取得したメール
+        """
         if isinstance(mail, Message):
             mail.forward(
                 subject=f'【OWAメール転送システム】Fwd: {mail.subject}',
@@ -121,34 +342,42 @@ class OwaAccount():
                 to_recipients=[self.forward_email]
             )
         elif isinstance(mail, BaseMeetingItem):
-            received_at = mail.datetime_received.astimezone(pytz.timezone('Asia/Tokyo'))
-            received_at_str = received_at.strftime('%Y/%m/%d %H:%M:%S')
-            received_at_str = received_at_str.replace(' ', f'({self.WEEKS[received_at.weekday()]}) ')
-
             self._send_email(
                 subject='【OWAメール転送システム】新着メール通知 (ミーティング)',
                 template='email/unread_mail.html',
                 extra_context={
                     'count': 1,
                     'mail_infos': [{
-                        'received_at': received_at_str,
+                        'received_at': self._format_received_at(mail.datetime_received),
                         'from': mail.author,
                         'subject': mail.subject,
                     }],
                 }
             )
 
-    def _set_read_flag(self, mail_id, value):
-        """未読フラグを設定
+    @timed('read_flags')
+    def _set_read_flags(self, mail_ids, value):
+        """未読フラグを一括設定
+
+        is_read のみを更新するUpdateItemを BULK_CHUNK_SIZE 件ずつまとめて送信する
+        一部のメールで失敗しても残りは設定を続け、失敗したメールは read_flag_failures に記録する
 
         Args:
-            mail_id(str): メール識別ID (Message.id)
+            mail_ids(list(str)): メール識別IDリスト (Message.id)
             value(bool): True (開封済み) / False (未開封)
+        Returns:
+            list(tuple(str, Exception)): 設定に失敗したメール識別IDと例外のリスト
         """
-        mail = self.account.inbox.get(id=mail_id)
-        mail.is_read = value
-        mail.save()
+        items = [(Message(account=self.account, id=mail_id, is_read=value), ['is_read']) for mail_id in mail_ids]
+        results = self.account.bulk_update(items=items, chunk_size=self.BULK_CHUNK_SIZE)
 
+        failures = [
+            (mail_id, result) for mail_id, result in zip(mail_ids, results) if isinstance(result, Exception)
+        ]
+        self.read_flag_failures.extend(failures)
+        return failures
+
+    @timed('notify')
     def _send_email(self, subject, template, extra_context=None):
         """メールを送信
 
@@ -174,6 +403,23 @@ class OwaAccount():
             import traceback
             print(traceback.format_exc())
 
+    def _send_unread_mail_email(self, count, mail_infos=None):
+        """新着メール通知を送信
+
+        Args:
+            count(int): 未読メール件数
+            mail_infos(list(dict)): メール情報リスト (差出人と件名を通知する場合のみ)
+        """
+        extra_context = {'count': count}
+        if mail_infos is not None:
+            extra_context['mail_infos'] = mail_infos
+
+        self._send_email(
+            subject='【OWAメール転送システム】新着メール通知',
+            template='email/unread_mail.html',
+            extra_context=extra_context
+        )
+
     def has_inbox(self):
         """受信ボックスが存在するか
         """
@@ -182,6 +428,44 @@ class OwaAccount():
         except (ErrorItemNotFound, ErrorNonExistentMailbox):
             return False
 
+    @timed('subscribe')
+    def subscribe(self, timeout):
+        """受信トレイおよびサブフォルダの新着メール通知を購読 (プル通知)
+
+        Args:
+            timeout(int): get_events が呼ばれない場合にサブスクリプションが失効するまでの時間 (分)
+        Returns:
+            tuple(str, str): サブスクリプションIDとウォーターマーク
+        """
+        service = Subscribe(account=self.account)
+        return service.call(self._get_target_folders(), self.SUBSCRIBE_EVENT_TYPES, timeout)
+
+    @timed('events')
+    def get_events(self, subscription_id, watermark):
+        """購読しているイベントを取得
+
+        Args:
+            subscription_id(str): サブスクリプションID
+            watermark(str): 前回のウォーターマーク
+        Returns:
+            tuple(list(tuple(str, str, str)), str): イベントリスト (種別, アイテムID, フォルダID) と次のウォーターマーク
+        """
+        events = []
+        service = GetEvents(account=self.account)
+        while True:
+            new_events, watermark, more_events = service.call(subscription_id, watermark)
+            events.extend(new_events)
+            if not more_events:
+                return events, watermark
+
+    def unsubscribe(self, subscription_id):
+        """購読を終了
+
+        Args:
+            subscription_id(str): サブスクリプションID
+        """
+        Unsubscribe(account=self.account).call(subscription_id)
+
     def send_unread_mail_count(self, keep_unread, last_time):
         """未読メールの件数を送信
 
@@ -195,15 +479,10 @@ class OwaAccount():
         if not mail_ids:
             return 0
 
-        self._send_email(
-            subject='【OWAメール転送システム】新着メール通知',
-            template='email/unread_mail.html',
-            extra_context={'count': len(mail_ids)}
-        )
+        self._send_unread_mail_email(len(mail_ids))
 
         if not keep_unread:
-            for mail_id in mail_ids:
-                self._set_read_flag(mail_id, True)
+            self._set_read_flags(mail_ids, True)
 
         return len(mail_ids)
 
@@ -220,18 +499,10 @@ class OwaAccount():
         if not mail_infos:
             return 0
 
-        self._send_email(
-            subject='【OWAメール転送システム】新着メール通知',
-            template='email/unread_mail.html',
-            extra_context={
-                'count': len(mail_infos),
-                'mail_infos': mail_infos,
-            }
-        )
+        self._send_unread_mail_email(len(mail_infos), mail_infos)
 
         if not keep_unread:
-            for mail_id in [mail_info['id'] for mail_info in mail_infos]:
-                self._set_read_flag(mail_id, True)
+            self._set_read_flags([mail_info['id'] for mail_info in mail_infos], True)
 
         return len(mail_infos)
 
@@ -248,13 +519,20 @@ class OwaAccount():
         if not mail_ids:
             return 0
 
-        for mail_id in mail_ids:
-            self._forward_mail(mail_id)
+        mails = self._fetch_mails(mail_ids)
+
+        forwarded_ids = []
+        try:
+            for mail in mails:
+                self._forward_mail(mail)
+                forwarded_ids.append(mail.id)
+        finally:
+            # 途中で失敗した場合も、転送済みのメールにはフラグを設定する
             if keep_unread:
                 # OWAから転送すると自動で開封済みになるため、転送後未開封に設定
-                self._set_read_flag(mail_id, False)
+                self._set_read_flags(forwarded_ids, False)
             else:
                 # 会議招待メールは転送できないため、手動で開封済みに設定
-                self._set_read_flag(mail_id, True)
+                self._set_read_flags(forwarded_ids, True)
 
         return len(mail_ids)
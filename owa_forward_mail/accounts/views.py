@@ -9,6 +9,7 @@ from django.views.generic import TemplateView, View
 from .auth import EmailAuthenticate
 from .forms import AccountForm, EditEmailForm, LoginForm
 from .models import ForwardEmail
+from ..dashboard.cache import get_user_data
 from ..utils.constant import Constant
 from ..utils.enum import MailAuthStatus
 
@@ -79,7 +80,7 @@ class AccountView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        forward_email = ForwardEmail.objects.get(user=self.request.user)
+        forward_email = get_user_data(self.request.user)['forward_email']
         form = AccountForm({
             'server': self.request.user.server,
             'email': self.request.user.email,
@@ -6,3 +6,4 @@ admin.site.register(accounts_models.User)
 admin.site.register(accounts_models.ForwardEmail)
 admin.site.register(applications_models.ForwardType)
 admin.site.register(applications_models.ForwardHistory)
+admin.site.register(applications_models.ForwardDailyStats)
@@ -0,0 +1,34 @@
+# Generated by Django 2.0.6 on 2026-10-18 12:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('applications', '0003_auto_20190126_0227'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderSyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('folder_id', models.CharField(max_length=512)),
+                ('sync_state', models.TextField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'folder_sync_state',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='foldersyncstate',
+            unique_together={('user', 'folder_id')},
+        ),
+    ]
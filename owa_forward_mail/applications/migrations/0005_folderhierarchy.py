@@ -0,0 +1,33 @@
+# Generated by Django 2.0.6 on 2026-10-18 13:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('applications', '0004_foldersyncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderHierarchy',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('sync_state', models.TextField()),
+                ('inbox_id', models.CharField(max_length=512)),
+                ('folders', models.TextField(default='{}')),
+                ('user', models.OneToOneField(
+                    on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL
+                )),
+            ],
+            options={
+                'db_table': 'folder_hierarchy',
+            },
+        ),
+    ]
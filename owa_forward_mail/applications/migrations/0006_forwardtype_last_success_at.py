@@ -0,0 +1,37 @@
+# Generated by Django 2.0.6 on 2026-10-18 21:16
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+from owa_forward_mail.utils.enum import ForwardStatus
+
+
+def set_last_success_at(apps, schema_editor):
+    """既存の転送履歴から最後に正常終了した日時を設定"""
+    ForwardHistory = apps.get_model('applications', 'ForwardHistory')
+    ForwardType = apps.get_model('applications', 'ForwardType')
+
+    last_success = ForwardHistory.objects.filter(
+        user=OuterRef('user'), status=ForwardStatus.get_values('valid')
+    ).order_by('-created_at').values('created_at')[:1]
+    ForwardType.objects.update(last_success_at=Subquery(last_success))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('applications', '0005_folderhierarchy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='forwardtype',
+            name='last_success_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='forwardhistory',
+            index=models.Index(fields=['user', 'created_at'], name='forward_his_user_id_57aa9f_idx'),
+        ),
+        migrations.RunPython(set_last_success_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 2.0.6 on 2026-10-18 21:24
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+from owa_forward_mail.utils.enum import ForwardStatus
+
+
+def create_daily_stats(apps, schema_editor):
+    """残っている転送履歴から日ごとの集計を作成"""
+    ForwardHistory = apps.get_model('applications', 'ForwardHistory')
+    ForwardDailyStats = apps.get_model('applications', 'ForwardDailyStats')
+
+    failure = Q(status__in=[ForwardStatus.get_values('auth_failure'), ForwardStatus.get_values('invalid')])
+    rows = ForwardHistory.objects.annotate(date=TruncDate('created_at')).values('user_id', 'date').annotate(
+        run_count=Count('id'),
+        new_mail_count=Sum('new_mail_count'),
+        failure_count=Count('id', filter=failure),
+    ).order_by()
+    ForwardDailyStats.objects.bulk_create([ForwardDailyStats(**row) for row in rows], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('applications', '0006_forwardtype_last_success_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForwardDailyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('date', models.DateField()),
+                ('run_count', models.IntegerField(default=0)),
+                ('new_mail_count', models.IntegerField(default=0)),
+                ('failure_count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'forward_daily_stats',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='forwarddailystats',
+            unique_together={('user', 'date')},
+        ),
+        migrations.RunPython(create_daily_stats, migrations.RunPython.noop),
+    ]
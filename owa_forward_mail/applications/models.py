@@ -1,3 +1,5 @@
+import json
+
 from django.db import models
 
 from ..accounts.models import User
@@ -12,6 +14,8 @@ class ForwardType(CreateAndUpdateDateTimeMixin):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     target = models.CharField(max_length=1, choices=FORWARD_TARGET, default=ForwardTarget.get_values('stop'))
     keep_unread = models.BooleanField(default=True)
+    # 最後に正常終了した転送処理の日時 (転送履歴を検索せずに新着メールの基準日時として参照する)
+    last_success_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         db_table = 'forward_type'
@@ -39,3 +43,52 @@ class ForwardHistory(CreateAndUpdateDateTimeMixin):
     class Meta:
         db_table = 'forward_history'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+        ]
+
+
+class ForwardDailyStats(CreateAndUpdateDateTimeMixin):
+    """日ごとの転送集計 (転送処理のたびに加算)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    # 転送処理の回数 (正常終了・失敗を含む)
+    run_count = models.IntegerField(default=0)
+    new_mail_count = models.IntegerField(default=0)
+    # 認証失敗・転送失敗の回数
+    failure_count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'forward_daily_stats'
+        ordering = ['-date']
+        unique_together = ('user', 'date')
+
+
+class FolderSyncState(CreateAndUpdateDateTimeMixin):
+    """フォルダの同期状態 (EWS SyncFolderItems)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    folder_id = models.CharField(max_length=512)
+    sync_state = models.TextField()
+
+    class Meta:
+        db_table = 'folder_sync_state'
+        unique_together = ('user', 'folder_id')
+
+
+class FolderHierarchy(CreateAndUpdateDateTimeMixin):
+    """受信トレイ配下のフォルダ階層のキャッシュ (EWS SyncFolderHierarchy)"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    sync_state = models.TextField()
+    inbox_id = models.CharField(max_length=512)
+    # サブフォルダのフォルダIDと変更キー (JSON)
+    folders = models.TextField(default='{}')
+
+    def to_dict(self):
+        return {
+            'sync_state': self.sync_state,
+            'inbox_id': self.inbox_id,
+            'folders': json.loads(self.folders),
+        }
+
+    class Meta:
+        db_table = 'folder_hierarchy'
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class OwaForwardMailConfig(AppConfig):
+    name = 'owa_forward_mail'
+
+    def ready(self):
+        # 転送設定・転送履歴の変更時にダッシュボードのキャッシュを破棄するシグナルを登録
+        from .dashboard import cache  # NOQA
@@ -0,0 +1,69 @@
+import datetime
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from ..accounts.models import ForwardEmail
+from ..applications.models import ForwardDailyStats, ForwardHistory, ForwardType
+
+# 日ごとの集計を表示する日数
+STATS_DAYS = 14
+
+
+def _get_key(user_id):
+    return f'user_data:{user_id}'
+
+
+def get_user_data(user):
+    """ダッシュボード・設定画面に表示するユーザーのデータを取得
+
+    2回目以降はキャッシュから返し、DBを参照しない
+    転送履歴の追加や設定の変更時に、シグナルで invalidate_user_data を呼び出して破棄する
+
+    Args:
+        user(User): ユーザー
+    Returns:
+        dict: forward_email, forward_type (未作成の場合は None), forward_histories, daily_stats (直近 STATS_DAYS 日)
+    """
+    # 日付が変わった場合は集計の期間が変わるため取得し直す
+    stats_since = timezone.localdate() - datetime.timedelta(days=STATS_DAYS)
+    key = _get_key(user.id)
+    data = cache.get(key)
+    if data is not None and data['stats_since'] == stats_since:
+        return data
+
+    data = {
+        'stats_since': stats_since,
+        'forward_email': ForwardEmail.objects.get(user=user),
+        'forward_type': ForwardType.objects.filter(user=user).first(),
+        'forward_histories': list(ForwardHistory.objects.filter(user=user)[:100]),
+        'daily_stats': list(ForwardDailyStats.objects.filter(user=user, date__gt=stats_since)),
+    }
+    cache.set(key, data)
+    return data
+
+
+def invalidate_user_data(user_id):
+    """get_user_data のキャッシュを破棄"""
+    cache.delete(_get_key(user_id))
+
+
+@receiver(post_save, sender=ForwardEmail)
+@receiver(post_delete, sender=ForwardEmail)
+@receiver(post_save, sender=ForwardType)
+@receiver(post_delete, sender=ForwardType)
+@receiver(post_save, sender=ForwardHistory)
+@receiver(post_delete, sender=ForwardHistory)
+@receiver(post_save, sender=ForwardDailyStats)
+@receiver(post_delete, sender=ForwardDailyStats)
+def _invalidate_on_change(sender, instance, **kwargs):
+    """画面・管理画面・runtask での変更時に get_user_data のキャッシュを破棄
+
+    トランザクション内の変更は、コミット前の内容をキャッシュしないようコミット後に破棄する
+    QuerySet.update ではシグナルが送られないため、同じトランザクションで転送履歴を作成して破棄する
+    """
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalidate_user_data(user_id))
@@ -6,9 +6,10 @@ from django.views.generic import TemplateView, View
 
 from ..accounts.auth import EmailAuthenticate
 from ..accounts.models import ForwardEmail
-from ..applications.models import ForwardHistory, ForwardType
+from ..applications.models import ForwardType
 from ..utils.constant import Constant
 from ..utils.enum import ForwardTarget, MailAuthStatus
+from .cache import STATS_DAYS, get_user_data
 
 
 class DashboardView(LoginRequiredMixin, TemplateView):
@@ -17,20 +18,16 @@ class DashboardView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        try:
-            forward_type = ForwardType.objects.get(user=self.request.user)
-        except ForwardType.DoesNotExist:
-            forward_type = None
-
-        forward_email = ForwardEmail.objects.get(user=self.request.user)
-        forward_histories = ForwardHistory.objects.filter(user=self.request.user)[:100]
+        user_data = get_user_data(self.request.user)
 
         context.update({
             'current': 'dashboard',
             'user': self.request.user,
-            'forward_email': forward_email,
-            'forward_type': forward_type,
-            'forward_histories': forward_histories,
+            'forward_email': user_data['forward_email'],
+            'forward_type': user_data['forward_type'],
+            'forward_histories': user_data['forward_histories'],
+            'daily_stats': user_data['daily_stats'],
+            'stats_days': STATS_DAYS,
             'constant': Constant,
         })
         return context
@@ -57,17 +54,12 @@ class EditForwardTypeView(LoginRequiredMixin, View):
     template_name = 'dashboard/edit_forward_type.html'
 
     def get(self, request):
-        forward_email = ForwardEmail.objects.get(user=request.user)
-        if forward_email.mail_auth != MailAuthStatus.get_values('done'):
+        user_data = get_user_data(request.user)
+        if user_data['forward_email'].mail_auth != MailAuthStatus.get_values('done'):
             return redirect('dashboard')
 
-        try:
-            forward_type = ForwardType.objects.get(user=request.user)
-        except ForwardType.DoesNotExist:
-            forward_type = None
-
         context = {
-            'forward_type': forward_type,
+            'forward_type': user_data['forward_type'],
             'constant': Constant,
         }
 
@@ -0,0 +1,753 @@
+"""EWSの疑似サーバー
+
+実際のExchange Serverを使わずに OwaAccount の動作確認や計測を行うための、EWS (SOAP) の最小限の実装
+exchangelib が送信するリクエストのうち、本システムが利用するサービスのみに応答する
+"""
+import base64
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytz
+from lxml import etree
+
+SOAPNS = 'http://schemas.xmlsoap.org/soap/envelope/'
+MNS = 'http://schemas.microsoft.com/exchange/services/2006/messages'
+TNS = 'http://schemas.microsoft.com/exchange/services/2006/types'
+NSMAP = {'s': SOAPNS, 'm': MNS, 't': TNS}
+
+
+def _m(tag):
+    return f'{{{MNS}}}{tag}'
+
+
+def _t(tag):
+    return f'{{{TNS}}}{tag}'
+
+
+def _localname(elem):
+    return etree.QName(elem).localname
+
+
+def _new_id():
+    return base64.b64encode(uuid.uuid4().bytes + uuid.uuid4().bytes).decode('ascii')
+
+
+def _format_datetime(value):
+    return value.astimezone(pytz.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _parse_datetime(value):
+    if value.endswith('Z'):
+        return pytz.utc.localize(datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+    naive = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    sign = 1 if value[-6] == '+' else -1
+    offset = timedelta(hours=int(value[-5:-3]), minutes=int(value[-2:]))
+    return pytz.utc.localize(naive - sign * offset)
+
+
+class FakeError(Exception):
+    """ResponseClass="Error" として返すエラー"""
+
+    def __init__(self, code, text=''):
+        super().__init__(code)
+        self.code = code
+        self.text = text or code
+
+
+class FakeFolder():
+    def __init__(self, name, parent=None, distinguished_id=None, folder_class='IPF.Note'):
+        self.id = _new_id()
+        self.changekey = _new_id()
+        self.name = name
+        self.parent = parent
+        self.distinguished_id = distinguished_id
+        self.folder_class = folder_class
+
+    def touch(self):
+        self.changekey = _new_id()
+
+
+class FakeItem():
+    def __init__(self, folder, subject, author_name, author_email, datetime_received, is_read=False,
+                 item_class='Message', body=''):
+        self.id = _new_id()
+        self.changekey = _new_id()
+        self.folder = folder
+        self.subject = subject
+        self.author_name = author_name
+        self.author_email = author_email
+        self.datetime_received = datetime_received
+        self.is_read = is_read
+        self.item_class = item_class
+        self.body = body
+
+    def touch(self):
+        self.changekey = _new_id()
+
+
+class FakeMailbox():
+    """疑似メールボックス
+
+    Args:
+        email(str): メールアドレス
+        username(str): ユーザー名
+        password(str): パスワード
+    """
+
+    def __init__(self, email, username, password):
+        self.email = email
+        self.username = username
+        self.password = password
+        self.lock = threading.RLock()
+
+        self.root = FakeFolder('root', distinguished_id='root', folder_class=None)
+        self.msgfolderroot = FakeFolder('Top of Information Store', self.root, 'msgfolderroot')
+        self.inbox = FakeFolder('受信トレイ', self.msgfolderroot, 'inbox')
+        self.sentitems = FakeFolder('送信済みアイテム', self.msgfolderroot, 'sentitems')
+        self.folders = OrderedDict((f.id, f) for f in (self.root, self.msgfolderroot, self.inbox, self.sentitems))
+        self.items = OrderedDict()
+        self.sent = []
+        self.sync_states = {}
+        # (イベント種別, アイテムID, フォルダID, 親フォルダID) のリスト 添字をウォーターマークとして使う
+        self.events = []
+        self.subscriptions = {}
+
+    def add_event(self, event_type, parent, item=None, folder=None):
+        with self.lock:
+            self.events.append((
+                event_type,
+                item.id if item else None,
+                folder.id if folder else None,
+                parent.id,
+            ))
+
+    def add_folder(self, name, parent=None):
+        with self.lock:
+            folder = FakeFolder(name, parent or self.inbox)
+            self.folders[folder.id] = folder
+            self.add_event('CreatedEvent', folder.parent, folder=folder)
+            return folder
+
+    def delete_folder(self, folder):
+        with self.lock:
+            for child in list(self.descendants(folder)) + [folder]:
+                del self.folders[child.id]
+                for item_id in [item.id for item in self.items.values() if item.folder is child]:
+                    del self.items[item_id]
+
+    def add_item(self, folder=None, subject='件名', author_name='差出人', author_email='sender@example.com',
+                 datetime_received=None, is_read=False, item_class='Message', body=''):
+        with self.lock:
+            item = FakeItem(
+                folder=folder or self.inbox,
+                subject=subject,
+                author_name=author_name,
+                author_email=author_email,
+                # EWSの日時は秒単位のため、検索条件と一致するよう秒未満を切り捨てる
+                datetime_received=(datetime_received or datetime.now(pytz.utc)).replace(microsecond=0),
+                is_read=is_read,
+                item_class=item_class,
+                body=body,
+            )
+            self.items[item.id] = item
+            self.add_event('NewMailEvent', item.folder, item=item)
+            self.add_event('CreatedEvent', item.folder, item=item)
+            return item
+
+    def add_unread_mails(self, count, folder=None, body_size=0, meeting_every=0):
+        """未読メールをまとめて追加
+
+        Args:
+            count(int): 件数
+            folder(FakeFolder): 追加先フォルダ (未指定の場合は受信トレイ)
+            body_size(int): 本文のバイト数
+            meeting_every(int): N件に1件を会議招待にする (0の場合は会議招待なし)
+        Returns:
+            list(FakeItem): 追加したメール
+        """
+        now = datetime.now(pytz.utc)
+        body = '<html><body>' + 'x' * body_size + '</body></html>' if body_size else ''
+        return [
+            self.add_item(
+                folder=folder,
+                subject=f'テストメール {i}',
+                author_name=f'差出人 {i % 10}',
+                author_email=f'sender{i % 10}@example.com',
+                datetime_received=now - timedelta(seconds=count - i),
+                item_class='MeetingRequest' if meeting_every and i % meeting_every == 0 else 'Message',
+                body=body,
+            )
+            for i in range(count)
+        ]
+
+    def descendants(self, folder):
+        children = [f for f in self.folders.values() if f.parent is folder]
+        for child in children:
+            yield child
+            yield from self.descendants(child)
+
+    def unread_items(self):
+        return [item for item in self.items.values() if not item.is_read]
+
+
+class FakeEwsService():
+    """SOAPリクエストを処理して応答を生成"""
+
+    SERVER_VERSION = {
+        'MajorVersion': '15',
+        'MinorVersion': '0',
+        'MajorBuildNumber': '1497',
+        'MinorBuildNumber': '2',
+    }
+
+    def __init__(self):
+        self.mailboxes = {}
+
+    def add_mailbox(self, mailbox):
+        self.mailboxes[mailbox.username] = mailbox
+
+    def authenticate(self, authorization):
+        if not authorization or not authorization.startswith('Basic '):
+            return None
+        username, _, password = base64.b64decode(authorization[6:]).decode('utf8').partition(':')
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None or mailbox.password != password:
+            return None
+        return mailbox
+
+    def handle(self, mailbox, body):
+        request = etree.fromstring(body)
+        version = request.find(f'{{{SOAPNS}}}Header/{_t("RequestServerVersion")}')
+        api_version = version.get('Version') if version is not None else 'Exchange2013'
+        payload = request.find(f'{{{SOAPNS}}}Body')[0]
+        service = _localname(payload)
+
+        handler = getattr(self, f'_{service}', None)
+        if handler is None:
+            # 対応していない操作は、Exchange Serverと同様にエラーの応答メッセージを返す
+            error = FakeError('ErrorInvalidRequest', f'{service} is not supported by the fake EWS server.')
+            return service, self._envelope(service, api_version, [self._message(service, error)])
+        with mailbox.lock:
+            messages = handler(mailbox, payload)
+        return service, self._envelope(service, api_version, messages)
+
+    def fault(self, text):
+        """SOAP Fault (HTTP 500 の応答本文)"""
+        envelope = etree.Element(f'{{{SOAPNS}}}Envelope', nsmap=NSMAP)
+        fault = etree.SubElement(etree.SubElement(envelope, f'{{{SOAPNS}}}Body'), f'{{{SOAPNS}}}Fault')
+        etree.SubElement(fault, 'faultcode').text = 'a:ErrorInternalServerError'
+        etree.SubElement(fault, 'faultstring').text = text
+        return etree.tostring(envelope, xml_declaration=True, encoding='utf-8')
+
+    def _envelope(self, service, api_version, messages):
+        envelope = etree.Element(f'{{{SOAPNS}}}Envelope', nsmap=NSMAP)
+        header = etree.SubElement(envelope, f'{{{SOAPNS}}}Header')
+        etree.SubElement(header, _t('ServerVersionInfo'), Version=api_version, **self.SERVER_VERSION)
+        response = etree.SubElement(etree.SubElement(envelope, f'{{{SOAPNS}}}Body'), _m(f'{service}Response'))
+        response_messages = etree.SubElement(response, _m('ResponseMessages'))
+        for message in messages:
+            response_messages.append(message)
+        return etree.tostring(envelope, xml_declaration=True, encoding='utf-8')
+
+    def _message(self, service, error=None):
+        if error:
+            message = etree.Element(_m(f'{service}ResponseMessage'), ResponseClass='Error')
+            etree.SubElement(message, _m('MessageText')).text = error.text
+            etree.SubElement(message, _m('ResponseCode')).text = error.code
+            etree.SubElement(message, _m('DescriptiveLinkKey')).text = '0'
+        else:
+            message = etree.Element(_m(f'{service}ResponseMessage'), ResponseClass='Success')
+            etree.SubElement(message, _m('ResponseCode')).text = 'NoError'
+        return message
+
+    # フォルダ
+
+    def _find_folder(self, mailbox, elem):
+        name = _localname(elem)
+        if name == 'DistinguishedFolderId':
+            for folder in mailbox.folders.values():
+                if folder.distinguished_id == elem.get('Id'):
+                    return folder
+        elif name == 'FolderId':
+            folder = mailbox.folders.get(elem.get('Id'))
+            if folder:
+                return folder
+        raise FakeError('ErrorFolderNotFound')
+
+    def _folder_elem(self, mailbox, folder):
+        elem = etree.Element(_t('Folder'))
+        etree.SubElement(elem, _t('FolderId'), Id=folder.id, ChangeKey=folder.changekey)
+        if folder.parent:
+            etree.SubElement(elem, _t('ParentFolderId'), Id=folder.parent.id, ChangeKey=folder.parent.changekey)
+        if folder.folder_class:
+            etree.SubElement(elem, _t('FolderClass')).text = folder.folder_class
+        etree.SubElement(elem, _t('DisplayName')).text = folder.name
+        items = [item for item in mailbox.items.values() if item.folder is folder]
+        etree.SubElement(elem, _t('TotalCount')).text = str(len(items))
+        etree.SubElement(elem, _t('ChildFolderCount')).text = str(
+            len([f for f in mailbox.folders.values() if f.parent is folder])
+        )
+        etree.SubElement(elem, _t('UnreadCount')).text = str(len([item for item in items if not item.is_read]))
+        return elem
+
+    def _GetFolder(self, mailbox, payload):
+        messages = []
+        for folder_id in payload.find(_m('FolderIds')):
+            try:
+                folder = self._find_folder(mailbox, folder_id)
+            except FakeError as e:
+                messages.append(self._message('GetFolder', e))
+                continue
+            message = self._message('GetFolder')
+            etree.SubElement(message, _m('Folders')).append(self._folder_elem(mailbox, folder))
+            messages.append(message)
+        return messages
+
+    def _page(self, service, container_tag, elems, view):
+        offset = int(view.get('Offset', '0')) if view is not None else 0
+        max_entries = int(view.get('MaxEntriesReturned', '0')) if view is not None else 0
+        page = elems[offset:offset + max_entries] if max_entries else elems[offset:]
+        next_offset = offset + len(page)
+
+        message = self._message(service)
+        root_folder = etree.SubElement(
+            message, _m('RootFolder'),
+            IndexedPagingOffset=str(next_offset),
+            TotalItemsInView=str(len(elems)),
+            IncludesLastItemInRange='true' if next_offset >= len(elems) else 'false',
+        )
+        container = etree.SubElement(root_folder, _t(container_tag))
+        for elem in page:
+            container.append(elem)
+        return message
+
+    def _FindFolder(self, mailbox, payload):
+        messages = []
+        deep = payload.get('Traversal') == 'Deep'
+        view = payload.find(_m('IndexedPageFolderView'))
+        for folder_id in payload.find(_m('ParentFolderIds')):
+            try:
+                parent = self._find_folder(mailbox, folder_id)
+            except FakeError as e:
+                messages.append(self._message('FindFolder', e))
+                continue
+            if deep:
+                folders = list(mailbox.descendants(parent))
+            else:
+                folders = [f for f in mailbox.folders.values() if f.parent is parent]
+            elems = [self._folder_elem(mailbox, folder) for folder in folders]
+            messages.append(self._page('FindFolder', 'Folders', elems, view))
+        return messages
+
+    # アイテム
+
+    def _requested_fields(self, payload):
+        shape = payload.find(_m('ItemShape'))
+        if shape is None:
+            return set()
+        return {elem.get('FieldURI') for elem in shape.iter(_t('FieldURI'))}
+
+    def _item_elem(self, item, fields):
+        elem = etree.Element(_t(item.item_class))
+        etree.SubElement(elem, _t('ItemId'), Id=item.id, ChangeKey=item.changekey)
+        if 'item:ParentFolderId' in fields:
+            etree.SubElement(elem, _t('ParentFolderId'), Id=item.folder.id, ChangeKey=item.folder.changekey)
+        if 'item:ItemClass' in fields:
+            etree.SubElement(elem, _t('ItemClass')).text = (
+                'IPM.Schedule.Meeting.Request' if item.item_class == 'MeetingRequest' else 'IPM.Note'
+            )
+        if 'item:Subject' in fields:
+            etree.SubElement(elem, _t('Subject')).text = item.subject
+        if 'item:Body' in fields:
+            etree.SubElement(elem, _t('Body'), BodyType='HTML').text = item.body
+        if 'item:DateTimeReceived' in fields:
+            etree.SubElement(elem, _t('DateTimeReceived')).text = _format_datetime(item.datetime_received)
+        if 'item:Size' in fields:
+            etree.SubElement(elem, _t('Size')).text = str(len(item.body) + 512)
+        if 'message:From' in fields:
+            mailbox = etree.SubElement(etree.SubElement(elem, _t('From')), _t('Mailbox'))
+            etree.SubElement(mailbox, _t('Name')).text = item.author_name
+            etree.SubElement(mailbox, _t('EmailAddress')).text = item.author_email
+            etree.SubElement(mailbox, _t('RoutingType')).text = 'SMTP'
+        if 'message:IsRead' in fields:
+            etree.SubElement(elem, _t('IsRead')).text = 'true' if item.is_read else 'false'
+        return elem
+
+    def _field_value(self, item, field_uri):
+        if field_uri == 'message:IsRead':
+            return item.is_read
+        if field_uri == 'item:DateTimeReceived':
+            return item.datetime_received
+        if field_uri == 'item:Subject':
+            return item.subject
+        raise FakeError('ErrorUnsupportedPathForQuery', field_uri)
+
+    def _constant(self, field_uri, value):
+        if field_uri == 'message:IsRead':
+            return value in ('true', '1')
+        if field_uri == 'item:DateTimeReceived':
+            return _parse_datetime(value)
+        return value
+
+    def _matches(self, elem, item):
+        name = _localname(elem)
+        if name in ('Restriction', 'And'):
+            return all(self._matches(child, item) for child in elem)
+        if name == 'Or':
+            return any(self._matches(child, item) for child in elem)
+        if name == 'Not':
+            return not self._matches(elem[0], item)
+
+        field_uri = elem.find(_t('FieldURI')).get('FieldURI')
+        value = self._field_value(item, field_uri)
+        constant = self._constant(field_uri, elem.find(f'{_t("FieldURIOrConstant")}/{_t("Constant")}').get('Value'))
+        if name == 'IsEqualTo':
+            return value == constant
+        if name == 'IsNotEqualTo':
+            return value != constant
+        if name == 'IsGreaterThan':
+            return value > constant
+        if name == 'IsGreaterThanOrEqualTo':
+            return value >= constant
+        if name == 'IsLessThan':
+            return value < constant
+        if name == 'IsLessThanOrEqualTo':
+            return value <= constant
+        raise FakeError('ErrorUnsupportedQueryFilter', name)
+
+    def _FindItem(self, mailbox, payload):
+        messages = []
+        fields = self._requested_fields(payload)
+        restriction = payload.find(_m('Restriction'))
+        sort_order = payload.find(_m('SortOrder'))
+        view = payload.find(_m('IndexedPageItemView'))
+        for folder_id in payload.find(_m('ParentFolderIds')):
+            try:
+                folder = self._find_folder(mailbox, folder_id)
+            except FakeError as e:
+                messages.append(self._message('FindItem', e))
+                continue
+            items = [item for item in mailbox.items.values() if item.folder is folder]
+            if restriction is not None:
+                items = [item for item in items if self._matches(restriction, item)]
+            if sort_order is not None:
+                for field_order in reversed(list(sort_order)):
+                    field_uri = field_order.find(_t('FieldURI')).get('FieldURI')
+                    items.sort(
+                        key=lambda item: self._field_value(item, field_uri),
+                        reverse=field_order.get('Order') == 'Descending'
+                    )
+            elems = [self._item_elem(item, fields) for item in items]
+            messages.append(self._page('FindItem', 'Items', elems, view))
+        return messages
+
+    def _GetItem(self, mailbox, payload):
+        messages = []
+        fields = self._requested_fields(payload)
+        for item_id in payload.find(_m('ItemIds')):
+            item = mailbox.items.get(item_id.get('Id'))
+            if item is None:
+                messages.append(self._message('GetItem', FakeError('ErrorItemNotFound')))
+                continue
+            message = self._message('GetItem')
+            etree.SubElement(message, _m('Items')).append(self._item_elem(item, fields))
+            messages.append(message)
+        return messages
+
+    def _UpdateItem(self, mailbox, payload):
+        messages = []
+        for item_change in payload.find(_m('ItemChanges')):
+            item = mailbox.items.get(item_change.find(_t('ItemId')).get('Id'))
+            if item is None:
+                messages.append(self._message('UpdateItem', FakeError('ErrorItemNotFound')))
+                continue
+            for is_read in item_change.iter(_t('IsRead')):
+                item.is_read = is_read.text in ('true', '1')
+            item.touch()
+            mailbox.add_event('ModifiedEvent', item.folder, item=item)
+
+            message = self._message('UpdateItem')
+            items = etree.SubElement(message, _m('Items'))
+            etree.SubElement(
+                etree.SubElement(items, _t(item.item_class)), _t('ItemId'), Id=item.id, ChangeKey=item.changekey
+            )
+            conflict_results = etree.SubElement(message, _m('ConflictResults'))
+            etree.SubElement(conflict_results, _t('Count')).text = '0'
+            messages.append(message)
+        return messages
+
+    def _CreateItem(self, mailbox, payload):
+        messages = []
+        for elem in payload.find(_m('Items')):
+            name = _localname(elem)
+            recipients = [address.text for address in elem.iter(_t('EmailAddress'))]
+            subject = elem.findtext(_t('Subject'))
+            if name == 'ForwardItem':
+                item = mailbox.items.get(elem.find(_t('ReferenceItemId')).get('Id'))
+                if item is None:
+                    messages.append(self._message('CreateItem', FakeError('ErrorItemNotFound')))
+                    continue
+                # OWAと同様に、転送したメールは開封済みになる
+                item.is_read = True
+                item.touch()
+                mailbox.add_event('ModifiedEvent', item.folder, item=item)
+            mailbox.sent.append({'type': name, 'subject': subject, 'to': recipients})
+
+            message = self._message('CreateItem')
+            etree.SubElement(message, _m('Items'))
+            messages.append(message)
+        return messages
+
+    def _SyncFolderItems(self, mailbox, payload):
+        try:
+            folder = self._find_folder(mailbox, payload.find(_m('SyncFolderId'))[0])
+        except FakeError as e:
+            return [self._message('SyncFolderItems', e)]
+        sync_state = payload.findtext(_m('SyncState'))
+        if sync_state and sync_state not in mailbox.sync_states:
+            return [self._message('SyncFolderItems', FakeError('ErrorInvalidSyncStateData'))]
+        max_changes = int(payload.findtext(_m('MaxChangesReturned')))
+        fields = self._requested_fields(payload)
+
+        snapshot = dict(mailbox.sync_states.get(sync_state, {}))
+        current = OrderedDict(
+            (item.id, item) for item in mailbox.items.values() if item.folder is folder
+        )
+        changes = []
+        for item_id, item in current.items():
+            if item_id not in snapshot:
+                changes.append(('Create', item))
+            elif snapshot[item_id] != (item.changekey, item.is_read):
+                if snapshot[item_id][1] != item.is_read:
+                    changes.append(('ReadFlagChange', item))
+                else:
+                    changes.append(('Update', item))
+        for item_id in snapshot:
+            if item_id not in current:
+                changes.append(('Delete', item_id))
+
+        page = changes[:max_changes]
+        for change_type, item in page:
+            if change_type == 'Delete':
+                del snapshot[item]
+            else:
+                snapshot[item.id] = (item.changekey, item.is_read)
+        # 変更がない場合は同じ同期状態を返す
+        new_state = sync_state if sync_state and not page else _new_id()
+        mailbox.sync_states[new_state] = snapshot
+
+        message = self._message('SyncFolderItems')
+        etree.SubElement(message, _m('SyncState')).text = new_state
+        etree.SubElement(message, _m('IncludesLastItemInRange')).text = (
+            'true' if len(page) == len(changes) else 'false'
+        )
+        container = etree.SubElement(message, _m('Changes'))
+        for change_type, item in page:
+            change = etree.SubElement(container, _t(change_type))
+            if change_type in ('Create', 'Update'):
+                change.append(self._item_elem(item, fields))
+            elif change_type == 'Delete':
+                etree.SubElement(change, _t('ItemId'), Id=item)
+            else:
+                etree.SubElement(change, _t('ItemId'), Id=item.id, ChangeKey=item.changekey)
+                etree.SubElement(change, _t('IsRead')).text = 'true' if item.is_read else 'false'
+        return [message]
+
+    def _SyncFolderHierarchy(self, mailbox, payload):
+        try:
+            parent = self._find_folder(mailbox, payload.find(_m('SyncFolderId'))[0])
+        except FakeError as e:
+            return [self._message('SyncFolderHierarchy', e)]
+        sync_state = payload.findtext(_m('SyncState'))
+        if sync_state and sync_state not in mailbox.sync_states:
+            return [self._message('SyncFolderHierarchy', FakeError('ErrorInvalidSyncStateData'))]
+
+        snapshot = mailbox.sync_states.get(sync_state, {})
+        current = OrderedDict((folder.id, folder) for folder in mailbox.descendants(parent))
+        new_snapshot = {folder_id: folder.changekey for folder_id, folder in current.items()}
+        # 変更がない場合は同じ同期状態を返す
+        new_state = sync_state if sync_state and new_snapshot == snapshot else _new_id()
+        mailbox.sync_states[new_state] = new_snapshot
+
+        message = self._message('SyncFolderHierarchy')
+        etree.SubElement(message, _m('SyncState')).text = new_state
+        etree.SubElement(message, _m('IncludesLastFolderInRange')).text = 'true'
+        container = etree.SubElement(message, _m('Changes'))
+        for folder_id, folder in current.items():
+            if folder_id not in snapshot:
+                change = etree.SubElement(container, _t('Create'))
+            elif snapshot[folder_id] != folder.changekey:
+                change = etree.SubElement(container, _t('Update'))
+            else:
+                continue
+            elem = etree.SubElement(change, _t('Folder'))
+            etree.SubElement(elem, _t('FolderId'), Id=folder.id, ChangeKey=folder.changekey)
+        for folder_id in snapshot:
+            if folder_id not in current:
+                change = etree.SubElement(container, _t('Delete'))
+                etree.SubElement(change, _t('FolderId'), Id=folder_id)
+        return [message]
+
+    # 通知
+
+    def _Subscribe(self, mailbox, payload):
+        request = payload.find(_m('PullSubscriptionRequest'))
+        if request is None:
+            return [self._message('Subscribe', FakeError('ErrorInvalidSubscriptionRequest'))]
+        try:
+            folders = [self._find_folder(mailbox, elem) for elem in request.find(_t('FolderIds'))]
+        except FakeError as e:
+            return [self._message('Subscribe', e)]
+
+        subscription_id = _new_id()
+        mailbox.subscriptions[subscription_id] = {
+            'folder_ids': {folder.id for folder in folders},
+            'event_types': {elem.text for elem in request.find(_t('EventTypes'))},
+        }
+        message = self._message('Subscribe')
+        etree.SubElement(message, _m('SubscriptionId')).text = subscription_id
+        etree.SubElement(message, _m('Watermark')).text = str(len(mailbox.events))
+        return [message]
+
+    def _GetEvents(self, mailbox, payload):
+        subscription = mailbox.subscriptions.get(payload.findtext(_m('SubscriptionId')))
+        if subscription is None:
+            return [self._message('GetEvents', FakeError('ErrorSubscriptionNotFound'))]
+        watermark = int(payload.findtext(_m('Watermark')))
+
+        message = self._message('GetEvents')
+        notification = etree.SubElement(message, _m('Notification'))
+        etree.SubElement(notification, _t('SubscriptionId')).text = payload.findtext(_m('SubscriptionId'))
+        etree.SubElement(notification, _t('PreviousWatermark')).text = str(watermark)
+        etree.SubElement(notification, _t('MoreEvents')).text = 'false'
+
+        events = [
+            (i + 1, event) for i, event in enumerate(mailbox.events[watermark:], watermark)
+            if event[0] in subscription['event_types'] and event[3] in subscription['folder_ids']
+        ]
+        if not events:
+            # イベントがない場合は StatusEvent で現在のウォーターマークを返す
+            status = etree.SubElement(notification, _t('StatusEvent'))
+            etree.SubElement(status, _t('Watermark')).text = str(len(mailbox.events))
+        for event_watermark, (event_type, item_id, folder_id, parent_folder_id) in events:
+            event = etree.SubElement(notification, _t(event_type))
+            etree.SubElement(event, _t('Watermark')).text = str(event_watermark)
+            etree.SubElement(event, _t('TimeStamp')).text = _format_datetime(datetime.now(pytz.utc))
+            if item_id:
+                etree.SubElement(event, _t('ItemId'), Id=item_id)
+            else:
+                etree.SubElement(event, _t('FolderId'), Id=folder_id)
+            etree.SubElement(event, _t('ParentFolderId'), Id=parent_folder_id)
+        if events and events[-1][0] < len(mailbox.events):
+            # 最後のイベント以降の購読対象外のイベントを読み飛ばせるよう、現在のウォーターマークを返す
+            status = etree.SubElement(notification, _t('StatusEvent'))
+            etree.SubElement(status, _t('Watermark')).text = str(len(mailbox.events))
+        return [message]
+
+    def _Unsubscribe(self, mailbox, payload):
+        if mailbox.subscriptions.pop(payload.findtext(_m('SubscriptionId')), None) is None:
+            return [self._message('Unsubscribe', FakeError('ErrorSubscriptionNotFound'))]
+        return [self._message('Unsubscribe')]
+
+    def _ResolveNames(self, mailbox, payload):
+        return [self._message('ResolveNames', FakeError('ErrorNameResolutionNoResults'))]
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send(404)
+
+    def do_POST(self):
+        server = self.server.fake_server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        mailbox = server.service.authenticate(self.headers.get('Authorization'))
+        if mailbox is None:
+            self._send(401, headers={'WWW-Authenticate': 'Basic realm="fake_ews"'})
+            return
+
+        if server.latency:
+            time.sleep(server.latency)
+        try:
+            service, response = server.service.handle(mailbox, body)
+        except Exception as e:
+            # 応答を返さずにスレッドが終了すると、クライアントからは接続が切れたように見えるため
+            self._send(500, server.service.fault(repr(e)), headers={'Content-Type': 'text/xml; charset=utf-8'})
+            return
+        server.record(service, len(body), len(response))
+        self._send(200, response, headers={'Content-Type': 'text/xml; charset=utf-8'})
+
+
+class FakeEwsServer():
+    """EWSの疑似サーバー
+
+    別スレッドでHTTPサーバーを起動し、service_endpoint で受け付ける
+
+    Args:
+        latency(float): 1リクエストごとに加える待ち時間 (秒)
+        host(str): 待ち受けるホスト
+        port(int): 待ち受けるポート (0の場合は空いているポート)
+    """
+
+    def __init__(self, latency=0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.service = FakeEwsService()
+        self.request_counts = Counter()
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self._lock = threading.Lock()
+        self._httpd = _ThreadingHTTPServer((host, port), _RequestHandler)
+        self._httpd.fake_server = self
+        self._thread = None
+
+    @property
+    def service_endpoint(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/EWS/Exchange.asmx'
+
+    def add_mailbox(self, mailbox):
+        self.service.add_mailbox(mailbox)
+        return mailbox
+
+    def record(self, service, request_size, response_size):
+        with self._lock:
+            self.request_counts[service] += 1
+            self.request_bytes += request_size
+            self.response_bytes += response_size
+
+    def reset_counts(self):
+        with self._lock:
+            self.request_counts.clear()
+            self.request_bytes = 0
+            self.response_bytes = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,142 @@
+import itertools
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from owa_forward_mail.accounts.owa_account import OwaAccount
+from owa_forward_mail.devtools.fake_ews import FakeEwsServer, FakeMailbox
+
+
+def _ids(owa_account):
+    return owa_account._get_unread_mail_ids(None)
+
+
+def _mails(owa_account):
+    return owa_account._fetch_mails(_ids(owa_account))
+
+
+def _forward_mails(owa_account, mails):
+    for mail in mails:
+        owa_account._forward_mail(mail)
+
+
+# 計測対象: 名前 -> (準備 (計測しない), 計測する処理)
+SCENARIOS = {
+    'get_unread_mail_ids': (None, lambda owa_account, _: owa_account._get_unread_mail_ids(None)),
+    'get_unread_mail_infos': (None, lambda owa_account, _: owa_account._get_unread_mail_infos(None)),
+    'forward_mail': (_mails, _forward_mails),
+    'set_read_flags': (_ids, lambda owa_account, mail_ids: owa_account._set_read_flags(mail_ids, True)),
+    'send_unread_mail_count': (None, lambda owa_account, _: owa_account.send_unread_mail_count(False, None)),
+    'send_unread_mail_subject': (None, lambda owa_account, _: owa_account.send_unread_mail_subject(False, None)),
+    'forward_unread_mail': (None, lambda owa_account, _: owa_account.forward_unread_mail(False, None)),
+}
+
+
+class Command(BaseCommand):
+    """OwaAccount の主な処理を疑似EWSサーバーに対して実行し、SOAPリクエスト数・所要時間・メモリ確保量を計測
+
+    Exchange Serverなしで性能の劣化を確認するためのもの
+    計測ごとに新しいメールボックスを作成するため、未読フラグの更新などは次の計測に影響しない
+    メモリ確保量は tracemalloc のピークで、同じプロセスで動く疑似サーバーの分を含む
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'scenarios', nargs='*', metavar='scenario',
+            help=f'計測する処理 (既定: 全て) {", ".join(SCENARIOS)}'
+        )
+        parser.add_argument('--mails', type=int, default=100, help='未読メールの件数 (サブフォルダを含む)')
+        parser.add_argument('--read-mails', type=int, default=0, help='既読メールの件数 (メールボックスの大きさ)')
+        parser.add_argument('--folders', type=int, default=0, help='未読メールを分けて入れるサブフォルダの数')
+        parser.add_argument('--meeting-every', type=int, default=0, help='N件に1件を会議招待にする')
+        parser.add_argument('--latency', type=float, default=0, help='1リクエストごとに加える待ち時間 (秒)')
+        parser.add_argument('--repeat', type=int, default=5, help='処理ごとの計測回数 (所要時間は中央値)')
+        parser.add_argument(
+            '--sync-state', action='store_true',
+            help='フォルダの同期状態とフォルダ階層を使って新着メールを取得 (runtask --sync-state と同じ)'
+        )
+
+    def _create_mailbox(self, options):
+        """計測用のメールボックスを作成"""
+        number = next(self._numbers)
+        mailbox = self.server.add_mailbox(
+            FakeMailbox(f'bench{number}@example.com', f'bench{number}', 'password')
+        )
+        for i in range(options['read_mails']):
+            mailbox.add_item(subject=f'既読メール {i}', is_read=True)
+
+        folders = [mailbox.inbox] + [mailbox.add_folder(f'サブフォルダ {i}') for i in range(options['folders'])]
+        mails = options['mails']
+        for i, folder in enumerate(folders):
+            count = mails // len(folders) + (1 if i < mails % len(folders) else 0)
+            mailbox.add_unread_mails(count, folder=folder, meeting_every=options['meeting_every'])
+        return mailbox
+
+    def _prepare(self, scenario, options):
+        """メールボックスの作成・ログイン・準備処理を行い、計測する処理を返す"""
+        prepare, run = SCENARIOS[scenario]
+        mailbox = self._create_mailbox(options)
+        owa_account = OwaAccount(
+            email=mailbox.email,
+            server=self.server.service_endpoint,
+            username=mailbox.username,
+            password=mailbox.password,
+            forward_email='forward@example.com',
+            sync_states={} if options['sync_state'] else None,
+            folder_hierarchy={} if options['sync_state'] else None,
+        )
+        args = prepare(owa_account) if prepare else None
+        self.server.reset_counts()
+        return lambda: run(owa_account, args)
+
+    def _measure(self, scenario, options):
+        """所要時間の中央値 (秒)・1回あたりのSOAPリクエスト数・応答のバイト数・メモリ確保のピーク (バイト)"""
+        times = []
+        for _ in range(options['repeat']):
+            run = self._prepare(scenario, options)
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        request_counts = dict(self.server.request_counts)
+        response_bytes = self.server.response_bytes
+
+        # tracemalloc は処理を遅くするため、所要時間とは別に1回だけ計測する
+        run = self._prepare(scenario, options)
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        return statistics.median(times), request_counts, response_bytes, peak
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat には1以上を指定してください')
+        unknown = [scenario for scenario in options['scenarios'] if scenario not in SCENARIOS]
+        if unknown:
+            raise CommandError(f'計測する処理は {", ".join(SCENARIOS)} から指定してください: {", ".join(unknown)}')
+
+        self.server = FakeEwsServer(latency=options['latency']).start()
+        self._numbers = itertools.count()
+        try:
+            # 疑似サーバーのURLにのみ直接接続を許可する
+            with override_settings(EWS_SERVICE_ENDPOINTS=[self.server.service_endpoint]):
+                self.stdout.write(
+                    f'未読 {options["mails"]} 件 / 既読 {options["read_mails"]} 件 / サブフォルダ {options["folders"]} / '
+                    f'待ち時間 {options["latency"] * 1000:.0f}ms'
+                )
+                for scenario in options['scenarios'] or SCENARIOS:
+                    elapsed, request_counts, response_bytes, peak = self._measure(scenario, options)
+                    requests = ', '.join(f'{service} {count}' for service, count in sorted(request_counts.items()))
+                    self.stdout.write(
+                        f'{scenario}: {elapsed * 1000:.1f}ms, '
+                        f'SOAP {sum(request_counts.values())} 回 ({requests}), 応答 {response_bytes / 1024:.1f}KiB, '
+                        f'メモリ確保 (ピーク) {peak / 1024:.1f}KiB'
+                    )
+        finally:
+            self.server.stop()
@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from owa_forward_mail.accounts.models import User
+from owa_forward_mail.devtools.fake_ews import FakeEwsServer, FakeMailbox
+
+
+class Command(BaseCommand):
+    """EWSの疑似サーバーを起動 (開発用)
+
+    登録済みユーザーのメールボックスを作成し、--deliver-interval ごとに各受信トレイへ未読メールを届ける
+    ユーザーのサーバーを表示されたURLに変更すると、runtask / listen を実際のExchange Serverなしで実行できる
+    (URLは設定の EWS_SERVICE_ENDPOINTS に含まれている必要がある)
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8765, help='待ち受けるポート')
+        parser.add_argument('--latency', type=float, default=0, help='1リクエストごとに加える待ち時間 (秒)')
+        parser.add_argument(
+            '--deliver-interval', type=int, default=0,
+            help='未読メールを届ける間隔 (秒) (既定: 0 = 届けない)'
+        )
+
+    def handle(self, *args, **options):
+        server = FakeEwsServer(latency=options['latency'], port=options['port'])
+        mailboxes = [
+            server.add_mailbox(FakeMailbox(user.email, user.plane_username, user.plane_password))
+            for user in User.objects.filter(is_superuser=False)
+        ]
+        server.start()
+        self.stdout.write(f'{server.service_endpoint} ({len(mailboxes)} mailboxes)')
+        if server.service_endpoint not in settings.EWS_SERVICE_ENDPOINTS:
+            self.stderr.write(f'runtask / listen から接続するには EWS_SERVICE_ENDPOINTS に {server.service_endpoint} を追加してください')
+
+        try:
+            while True:
+                if options['deliver_interval']:
+                    time.sleep(options['deliver_interval'])
+                    for mailbox in mailboxes:
+                        mailbox.add_unread_mails(1)
+                    self.stdout.write(f'{dict(server.request_counts)}')
+                else:
+                    time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
@@ -0,0 +1,184 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.db.models import Sum
+from django.test.utils import override_settings
+
+from owa_forward_mail.accounts.models import ForwardEmail, User
+from owa_forward_mail.applications.models import ForwardHistory, ForwardType
+from owa_forward_mail.devtools.fake_ews import FakeEwsServer, FakeMailbox
+from owa_forward_mail.management.commands.runtask import Command as RunTaskCommand
+from owa_forward_mail.utils.cipher import get_cipher
+from owa_forward_mail.utils.enum import ForwardStatus, ForwardTarget, MailAuthStatus
+from owa_forward_mail.utils.timing import percentile
+
+# 負荷試験用のユーザーのメールアドレスのドメイン (このドメインのユーザーのみ作成・処理・削除する)
+DOMAIN = 'loadtest.example.com'
+
+
+class LoadTestRunTaskCommand(RunTaskCommand):
+    """負荷試験用のユーザーのみを処理する runtask"""
+
+    def _get_user_queryset(self):
+        return super()._get_user_queryset().filter(email__endswith=f'@{DOMAIN}')
+
+
+class QueryCounter():
+    """ワーカースレッドの接続を含め、全てのDB接続で実行したクエリ数を数える"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    @contextmanager
+    def counting(self):
+        # 接続済みのスレッドの接続には直接追加し、以降に接続したスレッドの接続には接続時に追加する
+        self._install(None, connection)
+        connection_created.connect(self._install)
+        try:
+            yield self
+        finally:
+            connection_created.disconnect(self._install)
+            connection.execute_wrappers.remove(self)
+
+
+class Command(BaseCommand):
+    """負荷試験用のユーザーとEWSの疑似サーバーを用意して runtask を実行し、処理性能を表示
+
+    転送種別 (件数・差出人と件名・全文) と未読フラグの扱いを順番に割り当てたユーザーを作成し、
+    それぞれのメールボックスに未読メールを入れてから runtask と同じ処理を1回行う
+    Slackへの通知とメールの送信は行わず、稼働時間に関係なく実行する
+    設定したDBにユーザーを作成・削除するため、LOADTEST_ENABLED = True の環境でのみ実行できる
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='作成するユーザー数')
+        parser.add_argument('--mails', type=int, default=10, help='ユーザーごとの未読メールの件数')
+        parser.add_argument('--latency', type=float, default=0, help='1リクエストごとに加える待ち時間 (秒)')
+        parser.add_argument('--workers', type=int, default=1, help='runtask の --workers')
+        parser.add_argument('--sync-state', action='store_true', help='runtask の --sync-state')
+        parser.add_argument('--report', help='runtask の --report (処理段階ごとの集計をJSONで出力)')
+        parser.add_argument('--keep', action='store_true', help='終了後に負荷試験用のユーザーを削除しない')
+
+    def _delete_users(self):
+        User.objects.filter(email__endswith=f'@{DOMAIN}').delete()
+
+    def _create_users(self, server, count, mails):
+        """負荷試験用のユーザーと転送設定を作成し、未読メールを入れたメールボックスを疑似サーバーに追加"""
+        cipher = get_cipher(settings.PERSONAL_CRYPTO_KEY)
+        User.objects.bulk_create(
+            [
+                User(
+                    server=server.service_endpoint,
+                    email=f'user{i}@{DOMAIN}',
+                    username=cipher.encrypt(f'loadtest{i}'),
+                    password=cipher.encrypt('password'),
+                )
+                for i in range(count)
+            ],
+            batch_size=1000
+        )
+
+        # bulk_create では id が設定されない DB があるため、作成したユーザーを取得し直す
+        users = list(User.objects.filter(email__endswith=f'@{DOMAIN}'))
+        targets = [ForwardTarget.get_values(target) for target in ('count', 'subject', 'mail')]
+        ForwardEmail.objects.bulk_create(
+            [
+                ForwardEmail(user=user, email=f'forward{i}@{DOMAIN}', mail_auth=MailAuthStatus.get_values('done'))
+                for i, user in enumerate(users)
+            ],
+            batch_size=1000
+        )
+        ForwardType.objects.bulk_create(
+            [
+                ForwardType(user=user, target=targets[i % len(targets)], keep_unread=bool(i // len(targets) % 2))
+                for i, user in enumerate(users)
+            ],
+            batch_size=1000
+        )
+
+        for i, user in enumerate(users):
+            mailbox = server.add_mailbox(FakeMailbox(user.email, f'loadtest{i}', 'password'))
+            mailbox.add_unread_mails(mails)
+
+    def _write_summary(self, command, elapsed, query_count, server):
+        report = command.run_report.to_dict()
+        histories = ForwardHistory.objects.filter(user__email__endswith=f'@{DOMAIN}')
+        succeeded = histories.filter(status=ForwardStatus.get_values('valid'))
+        users = report['users']
+        mails = succeeded.aggregate(count=Sum('new_mail_count'))['count'] or 0
+
+        self.stdout.write(
+            f'ユーザー {users} 人 (正常終了 {succeeded.count()} / 失敗 {histories.count() - succeeded.count()}), '
+            f'新着 {mails} 件, {elapsed:.2f}秒'
+        )
+        self.stdout.write(f'スループット: {users / elapsed:.1f} ユーザー/秒, {mails / elapsed:.1f} 件/秒')
+
+        # ユーザー単位の所要時間 (各段階の合計)
+        latencies = sorted(sum(p['seconds'] for p in user['phases'].values()) for user in report['per_user'])
+        if latencies:
+            self.stdout.write(
+                'ユーザーごとの所要時間: ' + ', '.join(
+                    f'p{percent} {percentile(latencies, percent) * 1000:.0f}ms' for percent in (50, 90, 99)
+                ) + f', max {latencies[-1] * 1000:.0f}ms'
+            )
+        for phase, stats in report['phases'].items():
+            self.stdout.write(
+                f'  {phase}: {stats["count"]} 回, p50 {stats["p50"] * 1000:.1f}ms, p99 {stats["p99"] * 1000:.1f}ms'
+            )
+
+        requests = ', '.join(f'{service} {count}' for service, count in sorted(server.request_counts.items()))
+        self.stdout.write(f'SOAP {sum(server.request_counts.values())} 回 ({requests})')
+        self.stdout.write(f'DBクエリ {query_count} 回 ({query_count / max(users, 1):.1f} 回/ユーザー)')
+
+    def handle(self, *args, **options):
+        if not settings.LOADTEST_ENABLED:
+            raise CommandError('負荷試験は LOADTEST_ENABLED = True の環境 (開発環境・試験用DB) でのみ実行できます')
+        if options['users'] < 1:
+            raise CommandError('--users には1以上を指定してください')
+        if options['mails'] < 0:
+            raise CommandError('--mails には0以上を指定してください')
+
+        server = FakeEwsServer(latency=options['latency']).start()
+        try:
+            self._delete_users()
+            self._create_users(server, options['users'], options['mails'])
+            server.reset_counts()
+
+            command = LoadTestRunTaskCommand()
+            # Slackへの通知・メールの送信は行わない (Slackのバックエンドは最初の送信時に読み込まれる)
+            with override_settings(
+                EWS_SERVICE_ENDPOINTS=[server.service_endpoint],
+                OPERATING_HOURS=list(range(24)),
+                SLACK_BACKEND='django_slack.backends.DisabledBackend',
+                EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+            ), QueryCounter().counting() as query_counter:
+                start = time.perf_counter()
+                call_command(
+                    command,
+                    workers=options['workers'],
+                    sync_state=options['sync_state'],
+                    report=options['report'],
+                )
+                elapsed = time.perf_counter() - start
+
+            self._write_summary(command, elapsed, query_counter.count, server)
+        finally:
+            server.stop()
+            if not options['keep']:
+                self._delete_users()
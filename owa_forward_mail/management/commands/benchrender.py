@@ -0,0 +1,70 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template import Engine, engines
+
+# テンプレートを検索するローダー (settings の TEMPLATES と同じ)
+LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
+
+class Command(BaseCommand):
+    """通知メール・Slack通知の1通あたりの描画時間を計測
+
+    テンプレートをキャッシュしない場合 (DEBUG = True) とキャッシュする場合 (DEBUG = False) を、設定に関係なく比較する
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000, help='テンプレートごとの描画回数')
+        parser.add_argument('--mails', type=int, default=20, help='新着メール通知に含めるメール件数')
+
+    def _get_targets(self, mails):
+        to_email = 'user@example.com'
+        mail_infos = [
+            {
+                'received_at': '2019/01/01(火) 09:00:00',
+                'from': f'差出人 {i} <sender{i}@example.com>',
+                'subject': f'件名 {i}',
+            }
+            for i in range(mails)
+        ]
+        return [
+            ('email/unread_mail.html', {'to_email': to_email, 'count': mails, 'mail_infos': mail_infos}),
+            ('email/authentication_error.html', {'to_email': to_email}),
+            ('email/critical_error.html', {'to_email': to_email}),
+            ('slack/_line.slack', {'now': '09:00:00', 'level': 'INFO', 'user': None, 'title': '新着なし'}),
+        ]
+
+    def _measure(self, render, count):
+        """1回あたりの描画時間 (マイクロ秒)"""
+        start = time.perf_counter()
+        for _ in range(count):
+            render()
+        return (time.perf_counter() - start) / count * 1000000
+
+    def _get_engine(self, loaders):
+        """現在の設定と同じテンプレートディレクトリ・タグライブラリで、ローダーのみ指定した Engine"""
+        engine = engines['django'].engine
+        return Engine(dirs=engine.dirs, loaders=loaders, libraries=engine.libraries)
+
+    def handle(self, *args, **options):
+        count = options['count']
+        if count < 1:
+            raise CommandError('--count には1以上を指定してください')
+
+        loaders = [type(template_loader).__module__ for template_loader in engines['django'].engine.template_loaders]
+        self.stdout.write(f'現在の設定のローダー: {", ".join(loaders)}')
+
+        engine = self._get_engine(LOADERS)
+        cached_engine = self._get_engine([('django.template.loaders.cached.Loader', LOADERS)])
+        for template_name, context in self._get_targets(options['mails']):
+            # キャッシュする場合の初回のテンプレート検索・コンパイルは計測に含めない
+            cached_engine.render_to_string(template_name, context)
+
+            loader_time = self._measure(lambda: engine.render_to_string(template_name, context), count)
+            cached_time = self._measure(lambda: cached_engine.render_to_string(template_name, context), count)
+            self.stdout.write(
+                f'{template_name}: {loader_time:.1f}µs -> {cached_time:.1f}µs / 通 ({loader_time / cached_time:.1f}倍)'
+            )
@@ -0,0 +1,170 @@
+import time
+import traceback
+
+from exchangelib.errors import ErrorExpiredSubscription, ErrorInvalidSubscription, ErrorSubscriptionNotFound
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import close_old_connections
+from django.utils import timezone
+
+from owa_forward_mail.utils.cipher import get_cipher
+from owa_forward_mail.utils.email import SendEmailBatch
+from owa_forward_mail.utils.profiling import RunProfiler
+from owa_forward_mail.utils.slack import LogLevel, send_slack_message, slack_reporting
+from owa_forward_mail.utils.timing import RunReport
+
+from .runtask import Command as RunTaskCommand
+from .runtask import shard
+
+
+class Command(RunTaskCommand):
+    """新着メール通知 (EWSのプル通知) を待ち受け、新着メールが届いたユーザーのみ runtask と同じ処理を行う"""
+    # 購読が失効した場合のエラー (次の周期で購読し直す)
+    SUBSCRIPTION_ERRORS = (ErrorExpiredSubscription, ErrorInvalidSubscription, ErrorSubscriptionNotFound)
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=int, default=60,
+            help='新着メール通知を確認する間隔 (秒)'
+        )
+        parser.add_argument(
+            '--timeout', type=int, default=10,
+            help='通知を確認しなかった場合に購読が失効するまでの時間 (分)'
+        )
+        parser.add_argument(
+            '--ticks', type=int, default=0,
+            help='通知を確認する回数 (既定: 0 = 停止するまで)'
+        )
+        parser.add_argument(
+            '--shard', type=shard, default=(0, 1),
+            help='K個のプロセスで分担する場合に、User.id を K で割った余りが i のユーザーのみ処理 (例: 0/4)'
+        )
+        parser.add_argument(
+            '--sync-state', action='store_true',
+            help='フォルダの同期状態を保存し、前回からの変更のみで新着メールを取得'
+        )
+        parser.add_argument(
+            '--report',
+            help='周期ごとに処理段階ごとの所要時間と呼び出し回数を集計し、指定したパスにJSONで上書き出力'
+        )
+
+    def _subscribe(self, user):
+        """新着メール通知の購読を開始
+
+        購読していなかった間に届いたメールは、購読後に runtask と同じ処理で転送する
+        ログインしたアカウントは購読を終了するまで使い回す
+        """
+        owa_account = self._login(user, user.forwardemail)
+        if not owa_account:
+            return
+
+        subscription_id, watermark = owa_account.subscribe(self.timeout)
+        self._save_sync_states(user, owa_account)
+        self.listeners[user.id] = {
+            'owa_account': owa_account,
+            'subscription_id': subscription_id,
+            'watermark': watermark,
+        }
+
+        self._process_user(user, owa_account)
+
+    def _unsubscribe(self, user_id):
+        listener = self.listeners.pop(user_id, None)
+        if not listener:
+            return
+
+        try:
+            listener['owa_account'].unsubscribe(listener['subscription_id'])
+        except Exception:
+            # 購読はタイムアウトで失効するため、終了できなくても処理を続ける
+            pass
+
+    def _check_events(self, user, listener):
+        """新着メール通知を確認し、新着メールがあれば runtask と同じ処理を行う"""
+        # 購読時にログインしたアカウントを使い回すため、今回の周期の集計に記録する
+        listener['owa_account'].timer = self.run_report.add_user(user.id)
+        try:
+            events, listener['watermark'] = listener['owa_account'].get_events(
+                listener['subscription_id'], listener['watermark']
+            )
+        except self.SUBSCRIPTION_ERRORS:
+            # 次の周期で購読し直す
+            del self.listeners[user.id]
+            return
+
+        if any(folder_id for event_type, item_id, folder_id in events):
+            # サブフォルダが作成された場合は、作成されたフォルダを含めて次の周期で購読し直す
+            self._unsubscribe(user.id)
+        elif any(item_id for event_type, item_id, folder_id in events):
+            self._process_user(user, listener['owa_account'])
+
+    def _tick(self):
+        now = timezone.localtime()
+        if now.hour not in settings.OPERATING_HOURS:
+            # 稼働時間外は購読を終了し、稼働時間になってから購読し直す
+            for user_id in list(self.listeners):
+                self._unsubscribe(user_id)
+            return
+
+        users = list(self._get_users())
+
+        # 転送停止などで対象外になったユーザーの購読を終了
+        user_ids = {user.id for user in users}
+        for user_id in list(self.listeners):
+            if user_id not in user_ids:
+                self._unsubscribe(user_id)
+
+        for user in users:
+            try:
+                listener = self.listeners.get(user.id)
+                if listener:
+                    self._check_events(user, listener)
+                else:
+                    self._subscribe(user)
+            except Exception:
+                send_slack_message(LogLevel.error, user, 'エラー発生', traceback.format_exc(), channel=True)
+                self._unsubscribe(user.id)
+
+    def handle(self, *args, **options):
+        if options['interval'] < 1:
+            raise CommandError('--interval には1以上を指定してください')
+        if not 1 <= options['timeout'] <= 1440:
+            raise CommandError('--timeout には1から1440を指定してください')
+
+        self.use_sync_state = options['sync_state']
+        self.timeout = options['timeout']
+        self.shard = options['shard']
+        self.listeners = {}
+        self.email_batch = SendEmailBatch()
+        self.run_report = RunReport()
+        # runtask の --profile には対応しない
+        self.profiler = RunProfiler()
+
+        with slack_reporting():
+            send_slack_message(LogLevel.info, None, '待ち受け開始')
+            try:
+                tick = 0
+                while True:
+                    # 長時間動作するため、切断されたDB接続を破棄する
+                    close_old_connections()
+                    self.run_report = RunReport()
+                    # ユーザー名・パスワードの復号は周期ごとにメモリにキャッシュし、変更されたパスワードを次の周期で反映する
+                    with get_cipher(settings.PERSONAL_CRYPTO_KEY).cache_decrypted():
+                        self._tick()
+                    self._send_emails()
+                    if options['report']:
+                        self.run_report.write(options['report'])
+
+                    tick += 1
+                    if options['ticks'] and tick >= options['ticks']:
+                        break
+                    time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                send_slack_message(LogLevel.error, None, 'エラー発生', traceback.format_exc(), channel=True)
+            finally:
+                for user_id in list(self.listeners):
+                    self._unsubscribe(user_id)
+                self._send_emails()
+                send_slack_message(LogLevel.info, None, '待ち受け終了')
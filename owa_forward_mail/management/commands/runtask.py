@@ -1,81 +1,287 @@
+import argparse
+import json
+import queue
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from exchangelib.errors import UnauthorizedError
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Exists, F, OuterRef, Subquery
 from django.utils import timezone
 
-from owa_forward_mail.accounts.models import ForwardEmail, User
+from owa_forward_mail.accounts.models import User
 from owa_forward_mail.accounts.owa_account import OwaAccount
-from owa_forward_mail.applications.models import ForwardHistory, ForwardType
-from owa_forward_mail.utils.email import SendEmail
+from owa_forward_mail.applications.models import (
+    FolderHierarchy,
+    FolderSyncState,
+    ForwardDailyStats,
+    ForwardHistory,
+    ForwardType
+)
+from owa_forward_mail.utils.cipher import get_cipher
+from owa_forward_mail.utils.email import SendEmail, SendEmailBatch
 from owa_forward_mail.utils.enum import ForwardTarget, ForwardStatus, MailAuthStatus
-from owa_forward_mail.utils.slack import LogLevel, send_slack_message
+from owa_forward_mail.utils.profiling import RunProfiler
+from owa_forward_mail.utils.slack import LogLevel, send_slack_message, slack_reporting
+from owa_forward_mail.utils.timing import RunReport
+
+
+def shard(value):
+    """--shard の値 (i/K) を (i, K) に変換"""
+    try:
+        index, count = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'i/K の形式で指定してください: {value}')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'0 <= i < K を満たすように指定してください: {value}')
+    return index, count
+
+
+def chunks(iterable, size):
+    """iterable を size 件ずつのリストに分割"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 class Command(BaseCommand):
     RETRY_COUNT = 3
+    # ユーザーを読み込んで処理する単位 (全ユーザーをメモリに載せないよう、この件数ずつ処理する)
+    USER_CHUNK_SIZE = 1000
+    # 削除せずに残す転送履歴の件数 (今回の履歴と合わせてダッシュボードに表示する100件)
+    KEEP_HISTORY_COUNT = 99
 
-    def _is_valid_account(self, user, forward_email):
-        try:
-            OwaAccount(
-                server=user.server,
-                email=user.email,
-                username=user.plane_username,
-                password=user.plane_password
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='同時に処理するユーザー数 (既定: 1)'
+        )
+        parser.add_argument(
+            '--shard', type=shard, default=(0, 1),
+            help='K個のプロセスで分担する場合に、User.id を K で割った余りが i のユーザーのみ処理 (例: 0/4)'
+        )
+        parser.add_argument(
+            '--sync-state', action='store_true',
+            help='フォルダの同期状態を保存し、前回からの変更のみで新着メールを取得'
+        )
+        parser.add_argument(
+            '--report',
+            help='処理段階ごとの所要時間と呼び出し回数を集計し、指定したパスにJSONで出力'
+        )
+        parser.add_argument(
+            '--profile',
+            help='ユーザーごとの処理を cProfile とスタックの採取でプロファイルし、指定したディレクトリに出力'
+        )
+        parser.add_argument(
+            '--profile-top', type=int, default=10,
+            help='プロファイルの集計に分類ごとに表示する関数の数 (既定: 10)'
+        )
+
+    def _get_owa_account_kwargs(self, user, forward_email):
+        kwargs = {
+            'server': user.server,
+            'email': user.email,
+            'username': user.plane_username,
+            'password': user.plane_password,
+            'forward_email': forward_email.email,
+        }
+        if self.use_sync_state:
+            kwargs['sync_states'] = dict(
+                FolderSyncState.objects.filter(user=user).values_list('folder_id', 'sync_state')
             )
-            return True
-        except UnauthorizedError:
-            send_slack_message(LogLevel.warning, user, '認証失敗 (1)', channel=True)
 
+        # フォルダ階層は _get_users でユーザーとあわせて読み込んでいる
+        try:
+            kwargs['folder_hierarchy'] = user.folderhierarchy.to_dict()
+        except FolderHierarchy.DoesNotExist:
+            kwargs['folder_hierarchy'] = {}
+        return kwargs
+
+    def _save_sync_states(self, user, owa_account):
+        """同期状態とフォルダ階層を保存
+
+        転送などの処理に成功した場合のみ保存し、失敗した場合は次回も同じ変更を取得する
+        前回から変わっていない同期状態・フォルダ階層は書き込まない
+        同期状態を使わずに処理した場合は保存していた同期状態を削除し、
+        --sync-state に戻した後に古い同期状態からの変更を新着として扱わないようにする
+        """
+        old_sync_states = owa_account.sync_states or {}
+        sync_states = owa_account.new_sync_states
+        if self.use_sync_state and sync_states is not None:
+            deleted_folder_ids = set(old_sync_states) - set(sync_states)
+            changed_sync_states = {
+                folder_id: sync_state for folder_id, sync_state in sync_states.items()
+                if old_sync_states.get(folder_id) != sync_state
+            }
+        else:
+            deleted_folder_ids, changed_sync_states = set(), {}
+        # 同期状態の有無は _get_users でユーザーとあわせて取得している
+        delete_sync_states = not self.use_sync_state and user.has_sync_states
+
+        folder_hierarchy = owa_account.new_folder_hierarchy
+        old_folder_hierarchy = owa_account.folder_hierarchy or {}
+        if folder_hierarchy is not None and folder_hierarchy['sync_state'] == old_folder_hierarchy.get('sync_state'):
+            folder_hierarchy = None
+
+        if delete_sync_states or deleted_folder_ids or changed_sync_states or folder_hierarchy is not None:
+            with transaction.atomic():
+                if delete_sync_states:
+                    FolderSyncState.objects.filter(user=user).delete()
+                    user.has_sync_states = False
+                if deleted_folder_ids:
+                    # 削除されたフォルダの同期状態は削除
+                    FolderSyncState.objects.filter(user=user, folder_id__in=deleted_folder_ids).delete()
+                for folder_id, sync_state in changed_sync_states.items():
+                    FolderSyncState.objects.update_or_create(
+                        user=user,
+                        folder_id=folder_id,
+                        defaults={'sync_state': sync_state}
+                    )
+
+                if folder_hierarchy is not None:
+                    FolderHierarchy.objects.update_or_create(
+                        user=user,
+                        defaults={
+                            'sync_state': folder_hierarchy['sync_state'],
+                            'inbox_id': folder_hierarchy['inbox_id'],
+                            'folders': json.dumps(folder_hierarchy['folders']),
+                        }
+                    )
+        owa_account.commit_sync_states()
+
+    def _auth_failure(self, user, forward_email, step):
+        send_slack_message(LogLevel.warning, user, f'認証失敗 ({step})', channel=True)
+
+        with transaction.atomic():
             ForwardHistory.objects.create(user=user, status=ForwardStatus.get_values('auth_failure'))
-            user.need_password_change = True
-            user.save()
+            self._add_daily_stats(user, failure=True)
+        user.need_password_change = True
+        user.save()
 
-            title = '【OWAメール転送システム】OWAのログインに失敗しました'
-            template = 'email/authentication_error.html'
-            email = SendEmail(forward_email.email, title, template)
-            email.send()
+        title = '【OWAメール転送システム】OWAのログインに失敗しました'
+        template = 'email/authentication_error.html'
+        self.email_batch.add(SendEmail(forward_email.email, title, template), user)
 
-            return False
+    def _forward_failure(self, user, forward_type, forward_email):
+        send_slack_message(LogLevel.error, user, 'エラー発生', traceback.format_exc(), channel=True)
 
-    def _delete_old_histories(self, histories):
-        delete_ids = [history.id for history in histories[99:]]
-        ForwardHistory.objects.filter(id__in=delete_ids).delete()
+        forward_type.target = ForwardTarget.get_values('stop')
+        forward_type.save()
 
-    def _get_last_time(self, user):
-        last_time = None
+        with transaction.atomic():
+            ForwardHistory.objects.create(user=user, status=ForwardStatus.get_values('invalid'))
+            self._add_daily_stats(user, failure=True)
 
-        histories = ForwardHistory.objects.filter(user=user).order_by('created_at')
-        if histories:
-            valid_history = histories.filter(user=user, status=ForwardStatus.get_values('valid'))
-            if valid_history:
-                last_time = valid_history.latest('created_at').created_at
+        title = '【OWAメール転送システム】転送エラーが発生しました'
+        template = 'email/critical_error.html'
+        self.email_batch.add(SendEmail(forward_email.email, title, template), user)
 
-            self._delete_old_histories(histories)
+    def _add_daily_stats(self, user, new_mail_count=0, failure=False):
+        """今日の集計に転送処理1回分を加算"""
+        stats = ForwardDailyStats.objects.filter(user=user, date=timezone.localdate())
+        values = {
+            'run_count': F('run_count') + 1,
+            'new_mail_count': F('new_mail_count') + new_mail_count,
+            'failure_count': F('failure_count') + (1 if failure else 0),
+        }
+        if not stats.update(**values):
+            # その日の最初の転送処理では、集計を作成してから加算する
+            ForwardDailyStats.objects.get_or_create(user=user, date=timezone.localdate())
+            stats.update(**values)
 
-        return last_time
+    def _send_emails(self):
+        """ためておいた通知メールを1つのSMTP接続で送信し、送信に失敗したメールを報告"""
+        with self.run_report.timer.measure('smtp'):
+            failures = self.email_batch.send()
+        for send_email, user, error in failures:
+            send_slack_message(
+                LogLevel.error, user, 'メール送信失敗', f'{send_email.email.subject}\n{error!r}', channel=True
+            )
 
-    def _owa_process(self, user, forward_type, forward_email):
-        try:
-            owa_account = OwaAccount(
-                server=user.server,
-                email=user.email,
-                username=user.plane_username,
-                password=user.plane_password,
-                forward_email=forward_email.email,
-                enableFaultTolerance=True
+    def _forward_success(self, user, count):
+        if count:
+            send_slack_message(LogLevel.info, user, f'`新着 {count} 件`')
+        else:
+            send_slack_message(LogLevel.info, user, '新着なし')
+
+        with transaction.atomic():
+            history = ForwardHistory.objects.create(
+                user=user,
+                status=ForwardStatus.get_values('valid'),
+                new_mail_count=count
             )
-            last_time = self._get_last_time(user)
+            # update ではダッシュボードのキャッシュが破棄されないが、転送履歴の作成で破棄される
+            ForwardType.objects.filter(user=user).update(last_success_at=history.created_at)
+            self._add_daily_stats(user, new_mail_count=count)
+
+    def _report_read_flag_failures(self, user, owa_account):
+        failures = owa_account.read_flag_failures
+        if not failures:
+            return
+
+        details = '\n'.join(f'{mail_id}: {error!r}' for mail_id, error in failures)
+        send_slack_message(LogLevel.warning, user, f'未読フラグ設定失敗 {len(failures)} 件', details)
+        # 同じアカウントで次に処理する場合に、報告済みの失敗を再度報告しない
+        failures.clear()
+
+    def _login(self, user, forward_email):
+        """OWAにログイン
+
+        ログインしたアカウントをそのまま転送処理まで使い回す
+
+        Returns:
+            OwaAccount: 認証に失敗した場合は None
+        """
+        timer = self.run_report.add_user(user.id)
+        try:
+            with timer.measure('login'):
+                return OwaAccount(timer=timer, **self._get_owa_account_kwargs(user, forward_email))
+        except UnauthorizedError:
+            with timer.measure('db'):
+                self._auth_failure(user, forward_email, 1)
+            return None
+
+    def _delete_old_histories(self, user):
+        """ダッシュボードに表示する件数を超えた古い履歴を削除
+
+        今回の履歴と合わせて表示件数になるよう、新しい順に KEEP_HISTORY_COUNT 件を残す
+        """
+        cutoff = ForwardHistory.objects.filter(user=user).order_by('-created_at').values('created_at')
+        ForwardHistory.objects.filter(
+            user=user, created_at__lt=Subquery(cutoff[self.KEEP_HISTORY_COUNT - 1:self.KEEP_HISTORY_COUNT])
+        ).delete()
+
+    def _get_last_time(self, user, forward_type):
+        """新着メールの基準日時 (最後に正常終了した日時) を取得し、古い転送履歴を削除"""
+        self._delete_old_histories(user)
+
+        return forward_type.last_success_at
+
+    def _send_unread(self, owa_account, forward_type, last_time):
+        """転送種別に応じた処理を実行"""
+        if forward_type.target == ForwardTarget.get_values('count'):
+            return owa_account.send_unread_mail_count(forward_type.keep_unread, last_time)
+        elif forward_type.target == ForwardTarget.get_values('subject'):
+            return owa_account.send_unread_mail_subject(forward_type.keep_unread, last_time)
+        elif forward_type.target == ForwardTarget.get_values('mail'):
+            return owa_account.forward_unread_mail(forward_type.keep_unread, last_time)
+
+    def _owa_process(self, user, forward_type, forward_email, owa_account):
+        # DBの更新は 'db' として計測し、EWSの呼び出しは OwaAccount 側で段階ごとに計測する
+        timer = owa_account.timer
+        try:
+            with timer.measure('db'):
+                last_time = self._get_last_time(user, forward_type)
 
             for i in range(self.RETRY_COUNT + 1):
                 try:
-                    if forward_type.target == ForwardTarget.get_values('count'):
-                        count = owa_account.send_unread_mail_count(forward_type.keep_unread, last_time)
-                    elif forward_type.target == ForwardTarget.get_values('subject'):
-                        count = owa_account.send_unread_mail_subject(forward_type.keep_unread, last_time)
-                    elif forward_type.target == ForwardTarget.get_values('mail'):
-                        count = owa_account.forward_unread_mail(forward_type.keep_unread, last_time)
+                    count = self._send_unread(owa_account, forward_type, last_time)
                     break
                 except Exception:
                     if i < self.RETRY_COUNT:
@@ -85,67 +291,150 @@ class Command(BaseCommand):
                         continue
                     else:
                         raise
-            if count:
-                send_slack_message(LogLevel.info, user, f'`新着 {count} 件`')
-            else:
-                send_slack_message(LogLevel.info, user, '新着なし')
+            self._report_read_flag_failures(user, owa_account)
+            with timer.measure('db'):
+                self._save_sync_states(user, owa_account)
+                self._forward_success(user, count)
+        except UnauthorizedError:
+            with timer.measure('db'):
+                self._auth_failure(user, forward_email, 2)
+        except Exception:
+            with timer.measure('db'):
+                self._forward_failure(user, forward_type, forward_email)
 
-            ForwardHistory.objects.create(
-                user=user,
-                status=ForwardStatus.get_values('valid'),
-                new_mail_count=count
+    def _get_user_queryset(self):
+        """処理対象のユーザーのクエリセット
+
+        メール認証待ち・配信停止中のユーザーはSQLで除外する
+        """
+        users = User.objects.filter(
+            need_password_change=False,
+            is_superuser=False,
+            forwardemail__mail_auth=MailAuthStatus.get_values('done'),
+            forwardtype__isnull=False,
+        ).exclude(
+            forwardtype__target=ForwardTarget.get_values('stop')
+        ).select_related('forwardemail', 'forwardtype', 'folderhierarchy')
+        if not self.use_sync_state:
+            # 同期状態を使わない場合に、保存していた同期状態を削除するか判定する
+            users = users.annotate(
+                has_sync_states=Exists(FolderSyncState.objects.filter(user=OuterRef('pk')))
             )
-        except UnauthorizedError:
-            send_slack_message(LogLevel.warning, user, '認証失敗 (2)', channel=True)
 
-            ForwardHistory.objects.create(user=user, status=ForwardStatus.get_values('auth_failure'))
-            user.need_password_change = True
-            user.save()
+        shard_index, shard_count = self.shard
+        if shard_count > 1:
+            users = users.annotate(shard=F('id') % shard_count).filter(shard=shard_index)
+        return users
 
-            title = '【OWAメール転送システム】OWAのログインに失敗しました'
-            template = 'email/authentication_error.html'
-            email = SendEmail(forward_email.email, title, template)
-            email.send()
-        except Exception:
-            send_slack_message(LogLevel.error, user, 'エラー発生', traceback.format_exc(), channel=True)
+    def _get_users(self):
+        """処理対象のユーザーを転送先メールアドレス・転送種別・フォルダ階層とあわせて USER_CHUNK_SIZE 件ずつ読み込む"""
+        return self._get_user_queryset().iterator(chunk_size=self.USER_CHUNK_SIZE)
 
-            forward_type.target = ForwardTarget.get_values('stop')
-            forward_type.save()
+    def _get_forward_settings(self, user):
+        """転送設定を取得
 
-            ForwardHistory.objects.create(user=user, status=ForwardStatus.get_values('invalid'))
+        Args:
+            user(User): _get_users で取得したユーザー
+        Returns:
+            tuple(ForwardEmail, ForwardType)
+        """
+        forward_email = user.forwardemail
+        forward_type = user.forwardtype
 
-            title = '【OWAメール転送システム】転送エラーが発生しました'
-            template = 'email/critical_error.html'
-            email = SendEmail(forward_email.email, title, template)
-            email.send()
+        keep_unread = '残す' if forward_type.keep_unread else '残さない'
+        send_slack_message(LogLevel.info, user, f'{forward_type.get_target_display()} / {keep_unread}')
 
-    def handle(self, *args, **options):
+        return forward_email, forward_type
+
+    def _process_user(self, user, owa_account=None):
+        """ユーザーの転送処理
+
+        Args:
+            user(User): _get_users で取得したユーザー
+            owa_account(OwaAccount): ログイン済みのアカウント (未指定の場合はログインする)
+        """
+        with self.profiler.profile(f'user_{user.id}'):
+            forward_email, forward_type = self._get_forward_settings(user)
+
+            if owa_account is None:
+                owa_account = self._login(user, forward_email)
+            if owa_account:
+                self._owa_process(user, forward_type, forward_email, owa_account)
+
+    def _process_users_in_worker(self, user_queue):
+        """キューが空になるまでユーザーを取り出して処理 (ワーカースレッドで実行)
+
+        DB接続はスレッドごとに作られるため、ユーザーごとに閉じずに使い回し、最後にこのスレッドで閉じる
+        """
         try:
-            now = timezone.localtime()
-            if now.hour not in settings.OPERATING_HOURS:
-                return
+            while True:
+                try:
+                    user = user_queue.get_nowait()
+                except queue.Empty:
+                    return
 
-            send_slack_message(LogLevel.info, None, 'タスク開始')
+                try:
+                    self._process_user(user)
+                except Exception:
+                    # 他ユーザーの処理を止めないよう、ユーザー単位でエラーを閉じ込める
+                    send_slack_message(LogLevel.error, user, 'エラー発生', traceback.format_exc(), channel=True)
+        finally:
+            connection.close()
 
-            users = User.objects.filter(need_password_change=False, is_superuser=False)
-            for user in users:
-                forward_email = ForwardEmail.objects.get(user=user)
-                forward_type = ForwardType.objects.get(user=user)
+    def _process_users_in_threads(self, users, workers):
+        """workers 個のスレッドで USER_CHUNK_SIZE 件ずつユーザーを処理"""
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk in chunks(users, self.USER_CHUNK_SIZE):
+                user_queue = queue.Queue()
+                for user in chunk:
+                    user_queue.put(user)
+                futures = [
+                    executor.submit(self._process_users_in_worker, user_queue)
+                    for _ in range(min(workers, len(chunk)))
+                ]
+                for future in futures:
+                    future.result()
 
-                if (
-                    forward_email.mail_auth != MailAuthStatus.get_values('done')
-                    or forward_type.target == ForwardTarget.get_values('stop')
-                ):
-                    reason = 'メール認証待ち' if forward_email.mail_auth != MailAuthStatus.get_values('done') else '配信停止中'
-                    send_slack_message(LogLevel.warning, user, reason)
-                    continue
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError('--workers には1以上を指定してください')
+        self.use_sync_state = options['sync_state']
+        self.shard = options['shard']
+        self.email_batch = SendEmailBatch()
+        self.run_report = RunReport()
+        self.profiler = RunProfiler(options['profile'], options['profile_top']).start()
 
-                keep_unread = '残す' if forward_type.keep_unread else '残さない'
-                send_slack_message(LogLevel.info, user, f'{forward_type.get_target_display()} / {keep_unread}')
+        try:
+            # Slackへの通知はバックグラウンドで送信し、メールボックスの処理を待たせない
+            with slack_reporting(timer=self.run_report.timer):
+                try:
+                    now = timezone.localtime()
+                    if now.hour not in settings.OPERATING_HOURS:
+                        return
 
-                if self._is_valid_account(user, forward_email):
-                    self._owa_process(user, forward_type, forward_email)
+                    shard_index, shard_count = self.shard
+                    shard_label = f' (シャード {shard_index}/{shard_count})' if shard_count > 1 else ''
+                    send_slack_message(LogLevel.info, None, f'タスク開始{shard_label}')
 
-            send_slack_message(LogLevel.info, None, 'タスク終了')
-        except Exception:
-            send_slack_message(LogLevel.error, None, 'エラー発生', traceback.format_exc(), channel=True)
+                    users = self._get_users()
+                    # ユーザー名・パスワードの復号は実行中のみメモリにキャッシュする
+                    with get_cipher(settings.PERSONAL_CRYPTO_KEY).cache_decrypted():
+                        if workers > 1:
+                            self._process_users_in_threads(users, workers)
+                        else:
+                            for user in users:
+                                self._process_user(user)
+
+                    send_slack_message(LogLevel.info, None, f'タスク終了{shard_label}')
+                except Exception:
+                    send_slack_message(LogLevel.error, None, 'エラー発生', traceback.format_exc(), channel=True)
+                finally:
+                    self._send_emails()
+        finally:
+            # Slackへの送信が全て終わってから集計する
+            if options['report']:
+                self.run_report.write(options['report'])
+            summary = self.profiler.stop()
+            if summary:
+                self.stdout.write(summary)
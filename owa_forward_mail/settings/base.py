@@ -15,6 +15,24 @@ SLACK_FAIL_SILENTLY = True
 
 OPERATING_HOURS = [h for h in range(6, 25)]
 
+# サーバーにEWSのURLとして直接接続を許可するURL (疑似EWSサーバー用)
+# ユーザーが入力したサーバーで任意のURLへ認証情報を送らないよう、本番では空にする
+EWS_SERVICE_ENDPOINTS = []
+
+# loadtest の実行を許可するか (設定したDBに負荷試験用のユーザーを作成・削除するため、本番では無効にする)
+LOADTEST_ENABLED = False
+
+# ダッシュボード・設定画面のユーザーごとのキャッシュ
+# 既定のプロセス内のキャッシュには runtask による破棄が届かないため、短い時間で期限切れにする
+# Webとruntaskで共有できるキャッシュ (memcached など) を指定した場合は CACHE_TIMEOUT を長くできる
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+        'TIMEOUT': int(os.environ.get('CACHE_TIMEOUT', 60)),
+    }
+}
+
 DEBUG = False
 
 INSTALLED_APPS = [
@@ -26,7 +44,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'rest_framework',
     'django_slack',
-    'owa_forward_mail',
+    'owa_forward_mail.apps.OwaForwardMailConfig',
     'owa_forward_mail.accounts',
     'owa_forward_mail.applications',
 ]
@@ -49,7 +67,6 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -57,6 +74,13 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            # 通知メール・Slack通知のテンプレートの検索とコンパイルはプロセス内で1回だけ行う (DEBUG = True の場合は除く)
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
         },
     },
 ]
@@ -19,5 +19,19 @@ DATABASES = {
 
 DEBUG = True
 
+# 疑似EWSサーバーと計測用のコマンド (fakeews / benchowa / loadtest) は開発環境でのみ読み込む
+INSTALLED_APPS += ['owa_forward_mail.devtools']
+
+# 編集したテンプレートを再起動せずに反映するため、テンプレートをキャッシュしない
+TEMPLATES[0]['OPTIONS']['loaders'] = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
+# fakeews で起動した疑似EWSサーバー (既定のポート)
+EWS_SERVICE_ENDPOINTS = ['http://127.0.0.1:8765/EWS/Exchange.asmx']
+
+LOADTEST_ENABLED = True
+
 EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 EMAIL_FILE_PATH = './'
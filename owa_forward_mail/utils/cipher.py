@@ -1,15 +1,48 @@
+from contextlib import contextmanager
+from functools import lru_cache
+
 from cryptography.fernet import Fernet, InvalidToken
 
 
 class Cipher():
     def __init__(self, key):
         self.fernet = Fernet(key)
+        # 復号結果のキャッシュ (cache_decrypted の with ブロック内のみ有効)
+        self._decrypted = None
 
     def encrypt(self, plane):
         return self.fernet.encrypt(plane.encode('utf8')).decode('utf8')
 
     def decrypt(self, encrypted):
+        decrypted = self._decrypted
+        if decrypted is not None and encrypted in decrypted:
+            return decrypted[encrypted]
+
         try:
-            return self.fernet.decrypt(encrypted.encode('utf8')).decode('utf8')
+            plane = self.fernet.decrypt(encrypted.encode('utf8')).decode('utf8')
         except InvalidToken:
-            return ''
+            plane = ''
+
+        if decrypted is not None:
+            decrypted[encrypted] = plane
+        return plane
+
+    @contextmanager
+    def cache_decrypted(self):
+        """with ブロック内の復号結果をメモリにキャッシュし、同じ暗号文の復号を1回にする
+
+        キャッシュは一番外側のブロックを抜けると破棄する (入れ子にした場合は外側のキャッシュを使う)
+        """
+        previous = self._decrypted
+        if previous is None:
+            self._decrypted = {}
+        try:
+            yield
+        finally:
+            self._decrypted = previous
+
+
+@lru_cache(maxsize=None)
+def get_cipher(key):
+    """鍵ごとに1つの Cipher を返す (プロセス内で共有)"""
+    return Cipher(key)
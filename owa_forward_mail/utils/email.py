@@ -1,4 +1,6 @@
-from django.core.mail import EmailMultiAlternatives
+import threading
+
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template import loader
 
 
@@ -13,3 +15,54 @@ class SendEmail:
 
     def send(self):
         return self.email.send()
+
+
+class SendEmailBatch:
+    """SendEmail をためておき、1つのSMTP接続でまとめて送信"""
+
+    def __init__(self):
+        self._emails = []
+        self._lock = threading.Lock()
+
+    def add(self, send_email, user=None):
+        """送信するメールを追加
+
+        Args:
+            send_email(SendEmail): メール
+            user(User): 送信に失敗した場合に報告するユーザー
+        """
+        with self._lock:
+            self._emails.append((send_email, user))
+
+    def send(self):
+        """追加したメールを送信
+
+        メールごとに送信し、失敗しても残りのメールの送信を続ける
+
+        Returns:
+            list(tuple(SendEmail, User, Exception)): 送信に失敗したメール
+        """
+        with self._lock:
+            emails, self._emails = self._emails, []
+        if not emails:
+            return []
+
+        failures = []
+        connection = get_connection()
+        try:
+            for send_email, user in emails:
+                try:
+                    # 接続済みの場合は何もせず、同じ接続で送信する
+                    connection.open()
+                    connection.send_messages([send_email.email])
+                except Exception as e:
+                    failures.append((send_email, user, e))
+                    # 接続が切れている場合に備え、次のメールは接続し直して送信する
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+        finally:
+            connection.close()
+
+        return failures
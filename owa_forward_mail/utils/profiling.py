@@ -0,0 +1,171 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+# 集計する分類: 分類名 -> ファイル名・関数名に含まれる文字列 (C拡張の関数はファイル名がないため関数名で判定)
+CATEGORIES = [
+    ('exchangelib', ('/exchangelib/',)),
+    ('lxml', ('lxml',)),
+    ('Django ORM', ('/django/db/',)),
+    ('テンプレート', ('/django/template/',)),
+]
+OTHER_CATEGORY = 'その他'
+
+
+def get_category(func):
+    """pstats の関数 (ファイル名, 行番号, 関数名) の分類"""
+    filename, lineno, name = func
+    text = f'{filename}:{name}'.replace(os.sep, '/')
+    for category, patterns in CATEGORIES:
+        if any(pattern in text for pattern in patterns):
+            return category
+    return OTHER_CATEGORY
+
+
+class StackSampler():
+    """ラベルを設定したスレッドのスタックを一定間隔で採取
+
+    flamegraph.pl / speedscope で読み込める collapsed 形式 (ラベル;外側の関数;...;内側の関数 回数) で出力する
+    cProfile と異なり、通信の待ち時間を含めた実時間の内訳になる
+
+    Args:
+        interval(float): 採取する間隔 (秒)
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = Counter()
+        # スレッドIDごとのラベル
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def set_label(self, label):
+        """呼び出したスレッドを採取の対象にする"""
+        self._labels[threading.get_ident()] = label
+
+    def clear_label(self):
+        self._labels.pop(threading.get_ident(), None)
+
+    def _format_frame(self, frame):
+        code = frame.f_code
+        path = '/'.join(code.co_filename.replace(os.sep, '/').split('/')[-2:])
+        return f'{code.co_name} ({path}:{code.co_firstlineno})'
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, label in list(self._labels.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame:
+                    stack.append(self._format_frame(frame))
+                    frame = frame.f_back
+                stack.append(label)
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write(f'{stack} {count}\n')
+
+
+class RunProfiler():
+    """ユーザーごとの処理を cProfile とスタックの採取でプロファイル
+
+    directory に以下を出力する
+        users/<ラベル>.prof: ユーザーごとの cProfile の結果 (pstats / snakeviz などで読み込める)
+        run.prof: 全ユーザーの cProfile の結果をまとめたもの
+        run.folded: 採取したスタック (StackSampler 参照)
+        summary.txt: 分類ごとの実行時間と、実行時間 (tottime) の長い関数
+
+    Args:
+        directory(str): 出力先のディレクトリ (未指定の場合はプロファイルしない)
+        top(int): summary.txt に分類ごとに表示する関数の数
+        interval(float): スタックを採取する間隔 (秒)
+    """
+
+    def __init__(self, directory=None, top=10, interval=0.005):
+        self.directory = directory
+        self.top = top
+        self._sampler = StackSampler(interval) if directory else None
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.directory:
+            os.makedirs(os.path.join(self.directory, 'users'), exist_ok=True)
+            self._sampler.start()
+        return self
+
+    @contextmanager
+    def profile(self, label):
+        """with ブロックを label (ユーザーなど) の処理としてプロファイル
+
+        cProfile はスレッドごとに動作するため、with ブロックの処理は呼び出したスレッドで行うこと
+        """
+        if not self.directory:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        self._sampler.set_label(label)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._sampler.clear_label()
+            profile.dump_stats(os.path.join(self.directory, 'users', f'{label}.prof'))
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+
+    def _get_summary(self):
+        stats = self._stats
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        totals = Counter()
+        for func, (cc, nc, tt, ct, callers) in functions:
+            totals[get_category(func)] += tt
+
+        lines = [f'全体: {stats.total_tt:.3f}秒 (tottime の合計)']
+        for category in [category for category, patterns in CATEGORIES] + [OTHER_CATEGORY]:
+            lines.append(f'{category}: {totals[category]:.3f}秒 ({totals[category] / (stats.total_tt or 1):.0%})')
+            hottest = [item for item in functions if get_category(item[0]) == category][:self.top]
+            for func, (cc, nc, tt, ct, callers) in hottest:
+                lines.append(f'  {tt:9.3f}秒 {ct:9.3f}秒 {nc:8} 回  {pstats.func_std_string(func)}')
+        return '\n'.join(lines)
+
+    def stop(self):
+        """プロファイルを終了して結果を出力
+
+        Returns:
+            str: summary.txt の内容 (プロファイルしていない場合は None)
+        """
+        if not self.directory:
+            return None
+
+        self._sampler.stop()
+        self._sampler.write(os.path.join(self.directory, 'run.folded'))
+        if self._stats is None:
+            return None
+
+        self._stats.dump_stats(os.path.join(self.directory, 'run.prof'))
+        summary = self._get_summary()
+        with open(os.path.join(self.directory, 'summary.txt'), 'w', encoding='utf-8') as f:
+            f.write(summary + '\n')
+        return summary
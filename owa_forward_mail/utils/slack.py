@@ -1,3 +1,9 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from django.template.loader import render_to_string
 from django.utils import timezone
 from django_slack import slack_message
 
@@ -8,12 +14,111 @@ class LogLevel():
     error = 'ERROR'
 
 
+class SlackReporter():
+    """Slackへの通知をバックグラウンドのスレッドで送信
+
+    通常の通知は interval 秒ごとに1つのメッセージにまとめて送信し、@channel 付きの通知はすぐに送信する
+    呼び出し元はキューに積むだけのため、Slackの応答を待たない
+
+    Args:
+        interval(int): 通常の通知をまとめる間隔 (秒)
+        timer(PhaseTimer): 指定した場合は送信の所要時間を 'slack' として記録
+    """
+    # 1つのメッセージにまとめる最大行数
+    MAX_LINES = 50
+
+    def __init__(self, interval=10, timer=None):
+        self.interval = interval
+        self.timer = timer
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def put(self, line, channel):
+        self._queue.put((line, channel))
+
+    def stop(self):
+        """キューに残っている通知を全て送信してから終了"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _send(self, lines):
+        try:
+            if self.timer:
+                with self.timer.measure('slack'):
+                    slack_message('slack/lines.slack', {'lines': lines})
+            else:
+                slack_message('slack/lines.slack', {'lines': lines})
+        except Exception:
+            # 通知の失敗で送信スレッドを止めない
+            pass
+
+    def _run(self):
+        lines = []
+        flush_at = None
+        while True:
+            try:
+                message = self._queue.get(timeout=max(flush_at - time.monotonic(), 0) if lines else None)
+            except queue.Empty:
+                message = ()
+            if message is None:
+                break
+
+            if message:
+                line, channel = message
+                if channel:
+                    self._send([line])
+                else:
+                    if not lines:
+                        flush_at = time.monotonic() + self.interval
+                    lines.append(line)
+
+            if lines and (len(lines) >= self.MAX_LINES or time.monotonic() >= flush_at):
+                self._send(lines)
+                lines = []
+
+        if lines:
+            self._send(lines)
+
+
+# slack_reporting の with ブロック内で使用する SlackReporter
+_reporter = None
+
+
+@contextmanager
+def slack_reporting(interval=10, timer=None):
+    """with ブロック内の send_slack_message を SlackReporter で送信
+
+    ブロックを抜ける時に、まとめていた通知を送信する
+
+    Args:
+        interval(int): 通常の通知をまとめる間隔 (秒)
+        timer(PhaseTimer): 指定した場合は送信の所要時間を 'slack' として記録
+    """
+    global _reporter
+    _reporter = SlackReporter(interval, timer).start()
+    try:
+        yield
+    finally:
+        reporter, _reporter = _reporter, None
+        reporter.stop()
+
+
 def send_slack_message(level, user, title, extra_message=None, channel=False):
-    slack_message('slack/message.slack', {
+    context = {
         'now': timezone.localtime().strftime("%H:%M:%S"),
         'level': level,
         'user': user,
         'title': title,
         'extra_message': extra_message,
         'channel': channel,
-    })
+    }
+
+    reporter = _reporter
+    if reporter:
+        reporter.put(render_to_string('slack/_line.slack', context).strip(), channel)
+    else:
+        slack_message('slack/message.slack', context)
@@ -0,0 +1,149 @@
+import functools
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+
+class PhaseTimer():
+    """処理段階ごとの呼び出し回数と所要時間を記録
+
+    段階が入れ子になった場合、内側の段階の時間は外側の段階に含めない (各段階の合計が全体の時間になる)
+    --workers のように複数のスレッドから同時に計測してもよい
+    """
+
+    def __init__(self):
+        # 段階ごとの [呼び出し回数, 所要時間 (秒)]
+        self._phases = {}
+        self._lock = threading.Lock()
+        # スレッドごとの計測中の段階 (内側の段階の所要時間の合計)
+        self._local = threading.local()
+
+    @contextmanager
+    def measure(self, phase):
+        """with ブロックの所要時間を phase に加算
+
+        Args:
+            phase(str): 処理段階
+        """
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            inner = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                stats = self._phases.setdefault(phase, [0, 0.0])
+                stats[0] += 1
+                stats[1] += elapsed - inner
+
+    def get_phases(self):
+        """記録した回数と所要時間
+
+        Returns:
+            dict: 段階ごとの (呼び出し回数, 所要時間 (秒))
+        """
+        with self._lock:
+            return {phase: tuple(stats) for phase, stats in self._phases.items()}
+
+
+def timed(phase):
+    """メソッドの所要時間を self.timer (PhaseTimer) の phase に加算するデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.timer.measure(phase):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def percentile(values, percent):
+    """昇順に並べた values の percent パーセンタイル (最近傍法)"""
+    return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+
+class RunReport():
+    """1回の実行の処理段階ごとの所要時間を集計
+
+    ユーザーごとの PhaseTimer と、ユーザーに紐付かない処理 (Slack・SMTPの送信など) の timer をまとめ、
+    段階ごとにユーザー単位の所要時間の p50/p99 を求めてJSONで出力する
+    """
+
+    def __init__(self):
+        self.started_at = timezone.now()
+        self.timer = PhaseTimer()
+        self._user_timers = []
+        self._lock = threading.Lock()
+
+    def add_user(self, user_id):
+        """ユーザーの処理を記録する PhaseTimer を追加
+
+        同じユーザーを複数回処理した場合は、それぞれ別の処理として集計する
+
+        Args:
+            user_id(int): User.id
+        Returns:
+            PhaseTimer: 追加した timer
+        """
+        timer = PhaseTimer()
+        with self._lock:
+            self._user_timers.append((user_id, timer))
+        return timer
+
+    def to_dict(self):
+        """集計結果
+
+        Returns:
+            dict: started_at, finished_at, users (処理したユーザー数),
+                phases (段階ごとの count, seconds, p50, p99, max ※p50/p99/max はユーザー単位の所要時間),
+                run_phases (ユーザーに紐付かない段階の count, seconds), per_user (ユーザーごとの段階別 count, seconds)
+        """
+        with self._lock:
+            user_timers = list(self._user_timers)
+
+        per_user = []
+        samples = {}
+        for user_id, timer in user_timers:
+            phases = timer.get_phases()
+            per_user.append({
+                'user_id': user_id,
+                'phases': {phase: {'count': count, 'seconds': seconds} for phase, (count, seconds) in phases.items()},
+            })
+            for phase, stats in phases.items():
+                samples.setdefault(phase, []).append(stats)
+
+        phases = {}
+        for phase, stats in sorted(samples.items()):
+            seconds = sorted(s for c, s in stats)
+            phases[phase] = {
+                'count': sum(c for c, s in stats),
+                'seconds': sum(seconds),
+                'p50': percentile(seconds, 50),
+                'p99': percentile(seconds, 99),
+                'max': seconds[-1],
+            }
+
+        return {
+            'started_at': self.started_at.isoformat(),
+            'finished_at': timezone.now().isoformat(),
+            'users': len(user_timers),
+            'phases': phases,
+            'run_phases': {
+                phase: {'count': count, 'seconds': seconds}
+                for phase, (count, seconds) in sorted(self.timer.get_phases().items())
+            },
+            'per_user': per_user,
+        }
+
+    def write(self, path):
+        """集計結果をJSONファイルに出力"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)